@@ -0,0 +1,259 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+from encoding_store import ENCODING_SIZE, STORE_PATH, EncodingStore
+from gallery import Gallery, Match
+
+# Galleries smaller than ANN_MIN_SIZE are always matched exactly
+ANN_ENABLED = os.getenv("ANN_INDEX", "0") == "1"
+ANN_MIN_SIZE = int(os.getenv("ANN_MIN_SIZE", 20000))
+ANN_NLIST = int(os.getenv("ANN_NLIST", 0))
+# More probed lists = better recall, slower lookups
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", 8))
+
+
+def _sq_distances(queries, targets):
+    query_norms = np.einsum("ij,ij->i", queries, queries)
+    target_norms = np.einsum("ij,ij->i", targets, targets)
+    sq = query_norms[:, None] + target_norms[None, :] - 2.0 * (queries @ targets.T)
+    return np.maximum(sq, 0.0)
+
+
+def _nearest_centroid(vectors, centroids, chunk_size=8192):
+    assignment = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = vectors[start : start + chunk_size]
+        assignment[start : start + chunk_size] = np.argmin(
+            _sq_distances(chunk, centroids), axis=1
+        )
+    return assignment
+
+
+def kmeans(vectors, k, iterations=10, seed=0, sample_size=None):
+    rng = np.random.default_rng(seed)
+    sample_size = sample_size or k * 64
+    if len(vectors) > sample_size:
+        vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignment = _nearest_centroid(vectors, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # Re-seed empty clusters from random points
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    """Inverted-file index: encodings are bucketed by their nearest coarse
+    centroid and a lookup only scans the ``nprobe`` closest buckets.
+
+    Like Gallery, an index is never modified in place. ``updated`` returns a
+    new index that shares every untouched bucket with the old one, so a
+    reload can swap it in while the camera loop is still using the old one.
+    """
+
+    def __init__(self, centroids, lists, where, nprobe=ANN_NPROBE, trained_size=0):
+        self.centroids = centroids
+        # one (ids, names, vectors) tuple per centroid
+        self.lists = lists
+        # id -> bucket number
+        self.where = where
+        self.nprobe = nprobe
+        self.trained_size = trained_size
+
+    @classmethod
+    def build(cls, ids, names, vectors, nlist=None, nprobe=ANN_NPROBE, seed=0):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        nlist = nlist or max(1, int(4 * np.sqrt(len(vectors))))
+        nlist = min(nlist, len(vectors))
+        centroids = kmeans(vectors, nlist, seed=seed)
+        assignment = _nearest_centroid(vectors, centroids)
+
+        ids = np.asarray(ids, dtype=str)
+        names = np.asarray(names, dtype=str)
+        order = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[order], np.arange(nlist + 1))
+        lists = []
+        for bucket in range(nlist):
+            rows = order[bounds[bucket] : bounds[bucket + 1]]
+            lists.append((ids[rows], names[rows], np.ascontiguousarray(vectors[rows])))
+        where = {str(ids[i]): int(assignment[i]) for i in range(len(ids))}
+        return cls(centroids, lists, where, nprobe, trained_size=len(vectors))
+
+    @classmethod
+    def from_gallery(cls, gallery, nlist=None, nprobe=ANN_NPROBE):
+        return cls.build(_entry_ids(gallery), gallery.names(), gallery.matrix, nlist, nprobe)
+
+    def __len__(self):
+        return len(self.where)
+
+    def updated(self, added=(), removed=()):
+        """Return a new index with ``removed`` ids dropped and ``added``
+        (id, name, vector) entries inserted."""
+        lists = list(self.lists)
+        where = dict(self.where)
+        touched = {}
+
+        def bucket(number):
+            if number not in touched:
+                ids, names, vectors = lists[number]
+                touched[number] = (list(ids), list(names), list(vectors))
+            return touched[number]
+
+        for entry_id in removed:
+            number = where.pop(entry_id, None)
+            if number is not None:
+                ids, names, vectors = bucket(number)
+                position = ids.index(entry_id)
+                del ids[position], names[position], vectors[position]
+
+        added = list(added)
+        if added:
+            new_vectors = np.asarray([v for _, _, v in added], dtype=np.float32)
+            assignment = _nearest_centroid(new_vectors, self.centroids)
+            for (entry_id, name, _), vector, number in zip(added, new_vectors, assignment):
+                if entry_id in where:
+                    ids, names, vectors = bucket(where[entry_id])
+                    position = ids.index(entry_id)
+                    del ids[position], names[position], vectors[position]
+                ids, names, vectors = bucket(int(number))
+                ids.append(entry_id)
+                names.append(name)
+                vectors.append(vector)
+                where[entry_id] = int(number)
+
+        for number, (ids, names, vectors) in touched.items():
+            lists[number] = (
+                np.asarray(ids, dtype=str),
+                np.asarray(names, dtype=str),
+                np.asarray(vectors, dtype=np.float32).reshape(-1, ENCODING_SIZE),
+            )
+        return IVFIndex(self.centroids, lists, where, self.nprobe, self.trained_size)
+
+    def candidates(self, query):
+        nprobe = min(self.nprobe, len(self.lists))
+        centroid_distances = _sq_distances(query[None, :], self.centroids)[0]
+        probed = np.argpartition(centroid_distances, nprobe - 1)[:nprobe]
+        chosen = [self.lists[number] for number in probed if len(self.lists[number][0])]
+        if not chosen:
+            return None, None
+        names = np.concatenate([names for _, names, _ in chosen])
+        vectors = np.concatenate([vectors for _, _, vectors in chosen])
+        return names, vectors
+
+    def match(self, face_encodings, tolerance=0.6):
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        matches = []
+        for query in queries:
+            names, vectors = self.candidates(query)
+            if names is None:
+                matches.append(Match(None, float("inf"), float("inf")))
+                continue
+            distances = np.sqrt(_sq_distances(query[None, :], vectors)[0])
+            best = int(np.argmin(distances))
+            best_distance = float(distances[best])
+            # Margin to the closest candidate of a different person
+            others = distances[names != names[best]]
+            margin = float(others.min()) - best_distance if len(others) else float("inf")
+            name = str(names[best]) if best_distance <= tolerance else None
+            matches.append(Match(name, best_distance, margin))
+        return matches
+
+
+def _has_paths(gallery):
+    return all(path is not None for path in gallery.paths)
+
+
+def _entry_ids(gallery):
+    # Galleries built from bare arrays have no paths; their rows identify them
+    return gallery.paths if _has_paths(gallery) else [str(row) for row in range(len(gallery))]
+
+
+def index_for(gallery, previous=None, changed_paths=()):
+    """Build or incrementally update the ANN index for ``gallery``.
+
+    Returns None when the index is disabled or the gallery is small enough
+    for exact matching.
+    """
+    if not ANN_ENABLED or len(gallery) < ANN_MIN_SIZE:
+        return None
+    # Retrain the coarse quantizer when the gallery has grown a lot. Without
+    # paths rows cannot be matched to the previous index, so rebuild too
+    if (
+        previous is None
+        or len(gallery) > 2 * previous.trained_size
+        or not _has_paths(gallery)
+    ):
+        print(f"Building ANN index over {len(gallery)} encodings...")
+        return IVFIndex.from_gallery(gallery, ANN_NLIST or None, ANN_NPROBE)
+
+    changed = {os.path.normpath(path) for path in changed_paths}
+    current = {}
+    for row, path in enumerate(gallery.paths):
+        current[path] = row
+    removed = [path for path in previous.where if path not in current or path in changed]
+    added = [
+        (path, gallery.label_names[gallery.labels[row]], gallery.matrix[row])
+        for path, row in current.items()
+        if path not in previous.where or path in changed
+    ]
+    return previous.updated(added, removed)
+
+
+def verify_recall(gallery, index, sample=500, noise=0.03, tolerance=0.6, seed=0):
+    """Compare ANN results against exact search on perturbed gallery vectors."""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(gallery), min(sample, len(gallery)), replace=False)
+    queries = gallery.matrix[rows] + rng.normal(0, noise, (len(rows), ENCODING_SIZE)).astype(
+        np.float32
+    )
+
+    started = time.perf_counter()
+    exact = gallery.exact_match(queries, tolerance=float("inf"))
+    exact_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    approximate = index.match(queries, tolerance=float("inf"))
+    ann_seconds = time.perf_counter() - started
+
+    agree = sum(a.name == b.name for a, b in zip(exact, approximate))
+    return {
+        "queries": len(rows),
+        "recall": agree / len(rows),
+        "exact_ms_per_query": 1000.0 * exact_seconds / len(rows),
+        "ann_ms_per_query": 1000.0 * ann_seconds / len(rows),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check ANN recall against exact search")
+    parser.add_argument("--faces", default="faces/", help="face database directory")
+    parser.add_argument("--store", default=STORE_PATH, help="encoding store file")
+    parser.add_argument("--nlist", type=int, default=ANN_NLIST or None)
+    parser.add_argument("--nprobe", type=int, default=ANN_NPROBE)
+    parser.add_argument("--sample", type=int, default=500)
+    args = parser.parse_args()
+
+    store = EncodingStore(args.store).load()
+    store.sync(args.faces)
+    gallery = Gallery.from_store(store)
+    if len(gallery) == 0:
+        raise SystemExit("The gallery is empty")
+
+    index = IVFIndex.from_gallery(gallery, args.nlist, args.nprobe)
+    report = verify_recall(gallery, index, sample=args.sample)
+    print(
+        f"{len(index.lists)} lists, nprobe {index.nprobe}: recall@1 {report['recall']:.3f} "
+        f"over {report['queries']} queries, exact {report['exact_ms_per_query']:.3f} ms, "
+        f"ANN {report['ann_ms_per_query']:.3f} ms per query"
+    )
@@ -0,0 +1,107 @@
+import asyncio
+import hmac
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import bcrypt
+import jwt
+from fastapi import Header, HTTPException
+
+# bcrypt costs tens of milliseconds of CPU per call, so it runs on a small
+# thread pool and callers beyond the pending cap are turned away
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", 2))
+BCRYPT_MAX_PENDING = int(os.getenv("BCRYPT_MAX_PENDING", 32))
+
+JWT_SECRET = os.getenv("JWT_SECRET")
+JWT_ALGORITHM = "HS256"
+SESSION_TTL = int(os.getenv("SESSION_TTL", 7 * 24 * 3600))
+# AUTH_REQUIRED=0 is an explicit opt-out that still serves requests without
+# a token, for older app versions; a token that is sent is always verified
+AUTH_REQUIRED = os.getenv("AUTH_REQUIRED", "1") == "1"
+
+# Shared with the camera nodes, which send it as X-Node-Key to pull the
+# gallery of face encodings
+NODE_API_KEY = os.getenv("NODE_API_KEY")
+
+# Every worker and every restart must verify the tokens the others issued
+if not JWT_SECRET:
+    raise RuntimeError(
+        "JWT_SECRET is not set; set it to a long random string shared by all workers"
+    )
+
+
+class PasswordHasher:
+    def __init__(self, workers=BCRYPT_WORKERS, max_pending=BCRYPT_MAX_PENDING):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="bcrypt")
+        self.max_pending = max_pending
+        self.pending = 0
+
+    async def _run(self, function, *args):
+        if self.pending >= self.max_pending:
+            raise HTTPException(status_code=503, detail="Server busy, please retry")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, function, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password):
+        return await self._run(
+            lambda: bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+        )
+
+    async def check(self, password, hashed):
+        return await self._run(bcrypt.checkpw, password.encode("utf-8"), hashed)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def issue_token(user_id):
+    now = int(time.time())
+    payload = {"sub": user_id, "iat": now, "exp": now + SESSION_TTL}
+    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+
+def verify_token(token):
+    try:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Session expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid session token")
+    return payload["sub"]
+
+
+def session_user(authorization: Optional[str] = Header(None)):
+    """FastAPI dependency: the user id of the bearer token, if any."""
+    if not authorization:
+        if AUTH_REQUIRED:
+            raise HTTPException(status_code=401, detail="Not authenticated")
+        return None
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail="Invalid authorization header")
+    return verify_token(token)
+
+
+def authorize(user_id, session_user_id):
+    if session_user_id is not None and session_user_id != user_id:
+        raise HTTPException(status_code=403, detail="Not allowed for this user")
+
+
+def node_access(
+    x_node_key: Optional[str] = Header(None), authorization: Optional[str] = Header(None)
+):
+    """FastAPI dependency for camera node routes: the node key, or a session
+    token. Unlike ``session_user`` it is never optional."""
+    if x_node_key is not None:
+        if NODE_API_KEY and hmac.compare_digest(x_node_key.encode(), NODE_API_KEY.encode()):
+            return None
+        raise HTTPException(status_code=401, detail="Invalid node key")
+    if not authorization:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return session_user(authorization)
@@ -0,0 +1,275 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+import cv2
+import face_recognition
+import numpy as np
+
+from ann_index import IVFIndex, verify_recall
+from encoding_store import ENCODING_SIZE, STORE_PATH, is_face_image, load_store
+from gallery import Gallery
+from history_writer import HistoryWriter
+from tracking import FaceTracker, detect_faces
+from visits import VISIT_TIMEOUT, VisitTracker
+
+DEFAULT_SCALING = "100,1000,10000,100000,1000000"
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples[name].append(time.perf_counter() - started)
+
+    def summary(self):
+        return {name: latency_summary(values) for name, values in self.samples.items()}
+
+
+def latency_summary(seconds):
+    ms = 1000.0 * np.asarray(seconds, dtype=np.float64)
+    return {
+        "count": int(ms.size),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p90_ms": float(np.percentile(ms, 90)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+    }
+
+
+class NullCollection:
+    """Stands in for the MongoDB history collection."""
+
+    def insert_many(self, documents, ordered=True):
+        return None
+
+
+def video_frames(path, timer, max_frames=None):
+    cap = cv2.VideoCapture(path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+    count = 0
+    try:
+        while max_frames is None or count < max_frames:
+            with timer.stage("decode"):
+                ok, frame = cap.read()
+            if not ok:
+                break
+            count += 1
+            yield frame, 1.0 / fps
+    finally:
+        cap.release()
+
+
+def image_frames(directory, timer, frame_interval, max_frames=None):
+    # Every image is a separate sighting, spaced so each one closes its visit
+    paths = sorted(
+        os.path.join(root, file)
+        for root, _, files in os.walk(directory)
+        for file in files
+        if is_face_image(file)
+    )
+    for path in paths[:max_frames]:
+        with timer.stage("decode"):
+            frame = cv2.imread(path)
+        if frame is not None:
+            yield frame, frame_interval
+
+
+def replay(frames, gallery, timer, tracking=True, tolerance=0.7, mode="nearest"):
+    """Run frames through detection/tracking, encoding, matching, visits and
+    the history writer, as the camera node does, without any I/O to MongoDB
+    or the notification API."""
+    with tempfile.TemporaryDirectory(prefix="benchmark_history_") as history_dir:
+        writer = HistoryWriter(
+            NullCollection(), history_dir, spool_path=os.path.join(history_dir, "spool.jsonl")
+        ).start()
+        try:
+            result = _replay_frames(frames, gallery, timer, writer, tracking, tolerance, mode)
+        finally:
+            # Drains the queue, so the writer's own work is timed as well
+            writer.stop()
+    result["history_writer"] = writer.snapshot()
+    return result
+
+
+def _replay_frames(frames, gallery, timer, writer, tracking, tolerance, mode):
+    counters = defaultdict(int)
+
+    def on_open(visit):
+        counters["notifications"] += 1
+
+    def on_close(visit):
+        if visit.best_crop is None:
+            return
+        name = visit.name or "unknown"
+        # What the camera loop pays; encoding and writing happen on the writer thread
+        with timer.stage("persist"):
+            writer.submit(visit.best_crop, name, visit.recognized, visit.started)
+
+    tracker = FaceTracker()
+    visits = VisitTracker(on_open, on_close)
+    clock = 0.0
+    frame_id = 0
+    started = time.perf_counter()
+
+    for frame, interval in frames:
+        frame_id += 1
+        clock += interval
+        # The camera loop ticks continuously, so visits that ended during
+        # the gap between two replayed frames close before this one
+        visits.tick(now=clock)
+        with timer.stage("frame"):
+            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            if not tracking or tracker.due_for_detection(frame_id):
+                with timer.stage("detect"):
+                    boxes = detect_faces(rgb_frame, tracker.scale)
+                tracks = tracker.update(boxes, rgb_frame, frame_id)
+            else:
+                with timer.stage("track"):
+                    tracks = tracker.follow(rgb_frame, frame_id)
+
+            pending = [t for t in tracks if not tracking or tracker.needs_encoding(t, frame_id)]
+            matches = encodings = []
+            if pending:
+                with timer.stage("encode"):
+                    encodings = face_recognition.face_encodings(
+                        rgb_frame, [track.box for track in pending]
+                    )
+                with timer.stage("match"):
+                    matches = gallery.match(encodings, tolerance=tolerance, mode=mode)
+                for track, match in zip(pending, matches):
+                    tracker.set_identity(track, match, frame_id)
+
+            identified = {track.track_id: i for i, track in enumerate(pending)}
+            for track in tracks:
+                if track.match is None:
+                    continue
+                top, right, bottom, left = track.box
+                crop = rgb_frame[top:bottom, left:right]
+                i = identified.get(track.track_id)
+                if i is None:
+                    visits.observe(track.track_id, crop=crop, now=clock)
+                    continue
+                counters["recognized" if matches[i].name else "unknown"] += 1
+                visits.observe(track.track_id, matches[i], encodings[i], crop, now=clock)
+
+    visits.tick(now=clock + visits.timeout)
+    elapsed = time.perf_counter() - started
+    counters["frames"] = frame_id
+    return {
+        "frames": frame_id,
+        "seconds": elapsed,
+        "fps": frame_id / elapsed if elapsed else 0.0,
+        "counters": dict(counters),
+        "stages": timer.summary(),
+    }
+
+
+def synthetic_gallery(size, images_per_person=5, seed=0):
+    rng = np.random.default_rng(seed)
+    # Roughly the scale of dlib encodings, whose norms are close to 1
+    matrix = rng.normal(0, 1 / np.sqrt(ENCODING_SIZE), (size, ENCODING_SIZE)).astype(np.float32)
+    names = [f"person-{i // images_per_person}" for i in range(size)]
+    return Gallery(matrix, names, [str(i) for i in range(size)])
+
+
+def gallery_scaling(sizes, queries=8, repeats=5, ann=False, seed=0):
+    results = []
+    rng = np.random.default_rng(seed + 1)
+    for size in sizes:
+        gallery = synthetic_gallery(size, seed=seed)
+        rows = rng.choice(size, min(queries, size), replace=False)
+        batch = gallery.matrix[rows] + rng.normal(0, 0.03, (len(rows), ENCODING_SIZE)).astype(
+            np.float32
+        )
+        result = {"size": size, "queries": len(rows)}
+        for mode in ("nearest", "centroid"):
+            gallery.match(batch, mode=mode)  # warm-up, builds centroids once
+            timings = []
+            for _ in range(repeats):
+                started = time.perf_counter()
+                gallery.exact_match(batch, mode=mode)
+                timings.append((time.perf_counter() - started) / len(rows))
+            result[mode] = latency_summary(timings)
+
+        if ann:
+            started = time.perf_counter()
+            index = IVFIndex.from_gallery(gallery)
+            result["ann_build_seconds"] = time.perf_counter() - started
+            result["ann"] = verify_recall(gallery, index, sample=max(queries, 100))
+        print(f"Gallery of {size}: nearest {result['nearest']['p50_ms']:.3f} ms/query")
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the recognition pipeline")
+    parser.add_argument("--video", action="append", default=[], help="video file to replay")
+    parser.add_argument(
+        "--images", action="append", default=[], help="image directory to replay, e.g. history/"
+    )
+    parser.add_argument("--faces", default="faces/", help="face database used as gallery")
+    parser.add_argument("--store", default=STORE_PATH, help="encoding store file")
+    parser.add_argument("--max-frames", type=int, default=None, help="frames per input")
+    parser.add_argument("--tolerance", type=float, default=0.7)
+    parser.add_argument("--mode", default="nearest", choices=["nearest", "centroid"])
+    parser.add_argument(
+        "--scaling",
+        default=DEFAULT_SCALING,
+        help="comma separated synthetic gallery sizes, empty to skip",
+    )
+    parser.add_argument("--queries", type=int, default=8, help="faces per match call")
+    parser.add_argument("--ann", action="store_true", help="also build and time the ANN index")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON results file")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "args": vars(args),
+        },
+        "pipeline": [],
+        "scaling": [],
+    }
+
+    if args.video or args.images:
+        gallery = Gallery.from_store(load_store(args.faces, args.store))
+        results["meta"]["gallery_size"] = len(gallery)
+        for path in args.video:
+            timer = StageTimer()
+            run = replay(video_frames(path, timer, args.max_frames), gallery, timer,
+                         tracking=True, tolerance=args.tolerance, mode=args.mode)
+            results["pipeline"].append({"input": path, "kind": "video", **run})
+        for directory in args.images:
+            timer = StageTimer()
+            interval = VISIT_TIMEOUT + 1
+            run = replay(image_frames(directory, timer, interval, args.max_frames), gallery,
+                         timer, tracking=False, tolerance=args.tolerance, mode=args.mode)
+            results["pipeline"].append({"input": directory, "kind": "images", **run})
+        for run in results["pipeline"]:
+            print(f"{run['input']}: {run['frames']} frames at {run['fps']:.1f} fps")
+
+    if args.scaling:
+        sizes = [int(size) for size in args.scaling.split(",") if size]
+        results["scaling"] = gallery_scaling(sizes, args.queries, ann=args.ann)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,209 @@
+import os
+import threading
+
+import cv2
+import face_recognition
+import numpy as np
+
+from tracking import DETECTION_SCALE
+
+# Target time (ms) a recognition worker may spend on one frame; 0
+# keeps detection at DETECTION_SCALE and encodes every face
+FRAME_BUDGET_MS = float(os.getenv("FRAME_BUDGET_MS", 200))
+# Detection settings "scale:upsample" from the most to the least expensive
+DETECTION_LEVELS = os.getenv("DETECTION_LEVELS", "1.0:1,0.75:1,0.5:1,0.75:0,0.5:0,0.35:0")
+# Most faces encoded in one frame while the budget is on, 0 for no limit
+# besides the budget
+BUDGET_MAX_FACES = int(os.getenv("BUDGET_MAX_FACES", 4))
+# Detection frames between two detection level changes
+BUDGET_ADAPT_EVERY = int(os.getenv("BUDGET_ADAPT_EVERY", 10))
+# Faces failing one of these wait for a better frame; 0 disables a check
+FACE_MIN_SIZE = int(os.getenv("FACE_MIN_SIZE", 36))
+FACE_MIN_SHARPNESS = float(os.getenv("FACE_MIN_SHARPNESS", 20))
+# 0 is a frontal face, 1 a profile (nose in line with an eye)
+FACE_MAX_YAW = float(os.getenv("FACE_MAX_YAW", 0.6))
+# Crops are scaled to this size before measuring sharpness, so small and
+# large faces are judged alike
+SHARPNESS_SIZE = 64
+# Weight of the newest sample in the moving averages
+SMOOTHING = 0.2
+
+
+def parse_levels(text):
+    levels = []
+    for part in text.split(","):
+        if part.strip():
+            scale, upsample = part.split(":")
+            levels.append((float(scale), int(upsample)))
+    return levels
+
+
+def face_yaw(rgb_frame, box):
+    """How far the face is turned sideways, from the 5-point landmarks."""
+    landmarks = face_recognition.face_landmarks(rgb_frame, [box], model="small")
+    if not landmarks:
+        return None
+    points = landmarks[0]
+    left = np.mean([x for x, _ in points["left_eye"]])
+    right = np.mean([x for x, _ in points["right_eye"]])
+    nose = points["nose_tip"][0][0]
+    span = right - left
+    if abs(span) < 1:
+        return 1.0
+    return min(1.0, abs((nose - left) / span - 0.5) * 2)
+
+
+class QualityGate:
+    """Rejects faces too small, blurred or turned away to give a reliable
+    encoding. The cheap size and sharpness checks run before the landmark
+    based pose check."""
+
+    def __init__(
+        self, min_size=FACE_MIN_SIZE, min_sharpness=FACE_MIN_SHARPNESS, max_yaw=FACE_MAX_YAW
+    ):
+        self.min_size = min_size
+        self.min_sharpness = min_sharpness
+        self.max_yaw = max_yaw
+
+    def check(self, rgb_frame, box):
+        """None for a usable face, otherwise why it was rejected."""
+        top, right, bottom, left = box
+        if self.min_size and min(bottom - top, right - left) < self.min_size:
+            return "small"
+        if self.min_sharpness:
+            crop = rgb_frame[top:bottom, left:right]
+            if crop.size == 0:
+                return "small"
+            gray = cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY)
+            gray = cv2.resize(gray, (SHARPNESS_SIZE, SHARPNESS_SIZE), interpolation=cv2.INTER_AREA)
+            if cv2.Laplacian(gray, cv2.CV_64F).var() < self.min_sharpness:
+                return "blurred"
+        if self.max_yaw:
+            yaw = face_yaw(rgb_frame, box)
+            if yaw is None or yaw > self.max_yaw:
+                return "turned"
+        return None
+
+
+class FrameBudget:
+    """Picks the detection scale/upsample and the number of faces to encode
+    per frame so a frame takes about ``target_ms``.
+
+    Frame, detection and per-face encoding times are kept as moving
+    averages. Frames that run detection are the expensive ones, the
+    tracking frames in between only follow faces, so the level adapts on
+    detection frames alone: every ``adapt_every`` of them it drops one step
+    when they run over the target and climbs one when they take less than
+    half of it. Tracking frames are averaged separately. The faces allowed
+    are whatever the target leaves after detection, at least one.
+    """
+
+    def __init__(
+        self,
+        target_ms=FRAME_BUDGET_MS,
+        levels=DETECTION_LEVELS,
+        max_faces=BUDGET_MAX_FACES,
+        adapt_every=BUDGET_ADAPT_EVERY,
+    ):
+        self.target = target_ms / 1000.0
+        self.levels = parse_levels(levels) if isinstance(levels, str) else list(levels)
+        self.max_faces = max_faces
+        self.adapt_every = adapt_every
+        # Start where the fixed settings used to be; without levels the
+        # budget is off and the level unused
+        self.level = min(
+            range(len(self.levels)),
+            key=lambda i: (abs(self.levels[i][0] - DETECTION_SCALE), -self.levels[i][1]),
+            default=0,
+        )
+        # whole frames, with and without detection
+        self.detection_frame_seconds = None
+        self.tracking_frame_seconds = None
+        self.detect_seconds = None
+        self.face_seconds = None
+        self.detection_frames = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.target > 0 and bool(self.levels)
+
+    def detection(self):
+        """(scale, upsample) for the next detection."""
+        if not self.enabled:
+            return DETECTION_SCALE, 1
+        with self.lock:
+            return self.levels[self.level]
+
+    def faces_allowed(self):
+        """How many faces the next frame may encode, None for any number."""
+        if not self.enabled:
+            return None
+        limit = self.max_faces or None
+        with self.lock:
+            if self.face_seconds is None:
+                return limit
+            spare = self.target - (self.detect_seconds or 0.0)
+            allowed = max(1, int(spare / max(self.face_seconds, 1e-6)))
+        return allowed if limit is None else min(limit, allowed)
+
+    def record_detection(self, seconds):
+        with self.lock:
+            self.detect_seconds = _smooth(self.detect_seconds, seconds)
+
+    def record_encoding(self, seconds, faces):
+        if faces:
+            with self.lock:
+                self.face_seconds = _smooth(self.face_seconds, seconds / faces)
+
+    def record_frame(self, seconds, detected):
+        """Time of a whole frame; ``detected`` tells whether it ran detection."""
+        if not self.enabled:
+            return
+        with self.lock:
+            if not detected:
+                self.tracking_frame_seconds = _smooth(self.tracking_frame_seconds, seconds)
+                return
+            self.detection_frame_seconds = _smooth(self.detection_frame_seconds, seconds)
+            self.detection_frames += 1
+            if self.detection_frames < self.adapt_every:
+                return
+            self.detection_frames = 0
+            cost = self.detection_frame_seconds
+            if cost > self.target and self.level < len(self.levels) - 1:
+                self.level += 1
+            elif cost < self.target / 2 and self.level > 0:
+                self.level -= 1
+            else:
+                return
+            # Timings of the previous level no longer apply
+            self.detect_seconds = None
+            self.detection_frame_seconds = None
+
+
+def _smooth(average, sample):
+    return sample if average is None else average + SMOOTHING * (sample - average)
+
+
+def select_faces(rgb_frame, tracks, gate=None, limit=None):
+    """Split the tracks waiting for an encoding into those encoded now, new
+    faces and then the largest first, and a {track_id: reason} for the
+    rest, which stay pending for a later frame."""
+    accepted, held = [], {}
+    for track in tracks:
+        reason = gate.check(rgb_frame, track.box) if gate is not None else None
+        if reason is None:
+            accepted.append(track)
+        else:
+            held[track.track_id] = reason
+
+    def priority(track):
+        top, right, bottom, left = track.box
+        return track.match is not None, -(bottom - top) * (right - left)
+
+    accepted.sort(key=priority)
+    if limit is not None:
+        for track in accepted[limit:]:
+            held[track.track_id] = "budget"
+        accepted = accepted[:limit]
+    return accepted, held
@@ -0,0 +1,102 @@
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import OperationFailure
+
+from metrics import mongo_event_listeners
+
+MONGO_URI = os.getenv("MONGO_URI")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+# Seconds after which a gallery version still pending is taken to belong to
+# a worker that died before its write landed
+GALLERY_PENDING_TIMEOUT = float(os.getenv("GALLERY_PENDING_TIMEOUT", 60))
+
+# Motor runs every operation without blocking the event loop, so slow
+# queries no longer stall other requests or Socket.IO traffic
+client = AsyncIOMotorClient(
+    MONGO_URI,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    event_listeners=mongo_event_listeners(),
+)
+
+db = client["CameraDb"]
+users_collection = db["users"]
+pictures_collection = db["pictures"]
+history_collection = db["history"]
+counters_collection = db["counters"]
+notification_counts_collection = db["notification_counts"]
+# deleted pictures, so camera nodes syncing the gallery drop their vectors
+tombstones_collection = db["picture_tombstones"]
+
+INDEXES = [
+    (users_collection, [("email", ASCENDING)], {"unique": True}),
+    (pictures_collection, [("userId", ASCENDING), ("_id", DESCENDING)], {}),
+    (history_collection, [("date", DESCENDING), ("_id", DESCENDING)], {}),
+    (history_collection, [("userId", ASCENDING), ("_id", DESCENDING)], {}),
+    (pictures_collection, [("version", ASCENDING)], {}),
+    (pictures_collection, [("hash", ASCENDING)], {}),
+    (tombstones_collection, [("version", ASCENDING)], {}),
+]
+
+
+async def create_indexes():
+    for collection, keys, options in INDEXES:
+        try:
+            await collection.create_index(keys, **options)
+        except OperationFailure as e:
+            # e.g. duplicate emails already stored; the server still starts
+            print(f"Could not create index {keys} on {collection.name}: {e}")
+
+
+@asynccontextmanager
+async def gallery_versions(count=1):
+    """Reserve ``count`` gallery versions for a write made in the block and
+    yield the last of them.
+
+    The versions stay pending in the counter document until the block ends.
+    Taking and marking them is one atomic update, so every server worker
+    sees them and /gallery/sync never reports a version whose write has not
+    landed yet.
+    """
+    version = {"$add": [{"$ifNull": ["$version", 0]}, count]}
+    entry = {"first": {"$subtract": ["$version", count - 1]}, "at": "$$NOW"}
+    pending = {"$concatArrays": [{"$ifNull": ["$pending", []]}, [entry]]}
+    counter = await counters_collection.find_one_and_update(
+        {"_id": "gallery"},
+        [{"$set": {"version": version}}, {"$set": {"pending": pending}}],
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    last = counter["version"]
+    try:
+        yield last
+    finally:
+        # Also drops the versions of workers that died mid-write
+        stale = {"$subtract": ["$$NOW", GALLERY_PENDING_TIMEOUT * 1000]}
+        keep = {
+            "$and": [{"$ne": ["$$this.first", last - count + 1]}, {"$gt": ["$$this.at", stale]}]
+        }
+        await counters_collection.update_one(
+            {"_id": "gallery"},
+            [{"$set": {"pending": {"$filter": {"input": "$pending", "cond": keep}}}}],
+        )
+
+
+async def gallery_version():
+    """Newest version up to which every gallery write has landed."""
+    counter = await counters_collection.find_one({"_id": "gallery"})
+    if not counter:
+        return 0
+    # Pending entries carry MongoDB's clock, read back as naive UTC
+    cutoff = datetime.utcnow() - timedelta(seconds=GALLERY_PENDING_TIMEOUT)
+    pending = [entry["first"] for entry in counter.get("pending", []) if entry["at"] > cutoff]
+    return min(pending) - 1 if pending else counter["version"]
+
+
+def close():
+    client.close()
@@ -0,0 +1,295 @@
+import argparse
+import hashlib
+import os
+import time
+
+import face_recognition
+import numpy as np
+
+IMAGE_EXTENSIONS = (".jpg", ".png")
+ENCODING_SIZE = 128
+STORE_PATH = os.getenv("ENCODING_STORE_PATH", "encodings_store.npz")
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_face_image(path):
+    return path.endswith(IMAGE_EXTENSIONS)
+
+
+def iter_face_images(database_path):
+    # faces/<person_name>/<image>, the person name is the folder name
+    for person_name in sorted(os.listdir(database_path)):
+        person_folder = os.path.join(database_path, person_name)
+        if os.path.isdir(person_folder):
+            for file in sorted(os.listdir(person_folder)):
+                if is_face_image(file):
+                    yield person_name, os.path.normpath(os.path.join(person_folder, file))
+
+
+def person_name_for(image_path):
+    return os.path.basename(os.path.dirname(image_path))
+
+
+def encode_image(image_path):
+    image = face_recognition.load_image_file(image_path)
+    face_encs = face_recognition.face_encodings(image)
+    if not face_encs:
+        return None
+    return np.asarray(face_encs[0], dtype=np.float32)
+
+
+class EncodingStore:
+    """On-disk cache of face encodings keyed by image content hash.
+
+    Each record holds the image path, person name, mtime/size of the file
+    when it was hashed and a float32 encoding (``None`` when dlib found no
+    face, so such images are not re-encoded on every start either).
+    """
+
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+        # image path -> (hash, name, mtime, size)
+        self.files = {}
+        # content hash -> float32 encoding or None
+        self.vectors = {}
+        self.dirty = False
+
+    def load(self):
+        self.files = {}
+        self.vectors = {}
+        if not os.path.exists(self.path):
+            return self
+
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                paths = data["paths"]
+                hashes = data["hashes"]
+                names = data["names"]
+                mtimes = data["mtimes"]
+                sizes = data["sizes"]
+                has_face = data["has_face"]
+                vectors = data["vectors"]
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Encoding store {self.path} is unreadable ({e}), rebuilding it")
+            self.dirty = True
+            return self
+
+        for i in range(len(paths)):
+            content_hash = str(hashes[i])
+            self.files[str(paths[i])] = (
+                content_hash,
+                str(names[i]),
+                float(mtimes[i]),
+                int(sizes[i]),
+            )
+            self.vectors[content_hash] = vectors[i] if has_face[i] else None
+        self.dirty = False
+        return self
+
+    def save(self):
+        paths = sorted(self.files)
+        count = len(paths)
+        vectors = np.zeros((count, ENCODING_SIZE), dtype=np.float32)
+        has_face = np.zeros(count, dtype=bool)
+        for i, path in enumerate(paths):
+            vector = self.vectors.get(self.files[path][0])
+            if vector is not None:
+                vectors[i] = vector
+                has_face[i] = True
+
+        # Write to a temporary file first so a crash never leaves a torn store
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                paths=np.array(paths, dtype=str),
+                hashes=np.array([self.files[p][0] for p in paths], dtype=str),
+                names=np.array([self.files[p][1] for p in paths], dtype=str),
+                mtimes=np.array([self.files[p][2] for p in paths], dtype=np.float64),
+                sizes=np.array([self.files[p][3] for p in paths], dtype=np.int64),
+                has_face=has_face,
+                vectors=vectors,
+            )
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def update_file(self, image_path, name=None):
+        """Refresh a single image; returns "hit", "hash_hit", "miss" or "removed"."""
+        if not os.path.isfile(image_path):
+            if self.files.pop(image_path, None) is not None:
+                self.dirty = True
+            return "removed"
+
+        name = name or person_name_for(image_path)
+        stat = os.stat(image_path)
+        record = self.files.get(image_path)
+        if (
+            record is not None
+            and record[1] == name
+            and record[2] == stat.st_mtime
+            and record[3] == stat.st_size
+            and record[0] in self.vectors
+        ):
+            return "hit"
+
+        content_hash = file_hash(image_path)
+        result = "hash_hit"
+        if content_hash not in self.vectors:
+            print(f"Encoding image: {image_path}")
+            self.vectors[content_hash] = encode_image(image_path)
+            result = "miss"
+        self.files[image_path] = (content_hash, name, stat.st_mtime, stat.st_size)
+        self.dirty = True
+        return result
+
+    def update_paths(self, paths):
+        """Apply a batch of changed paths (files or whole person folders)."""
+        stats = {"hit": 0, "hash_hit": 0, "miss": 0, "removed": 0}
+        for path in sorted(os.path.normpath(p) for p in paths):
+            if os.path.isdir(path):
+                for file in sorted(os.listdir(path)):
+                    if is_face_image(file):
+                        stats[self.update_file(os.path.join(path, file))] += 1
+            elif is_face_image(path):
+                stats[self.update_file(path)] += 1
+
+            # A deleted or renamed folder only reports itself, drop its images too
+            prefix = os.path.join(path, "")
+            for image_path in [p for p in self.files if p.startswith(prefix)]:
+                if not os.path.isfile(image_path):
+                    del self.files[image_path]
+                    stats["removed"] += 1
+                    self.dirty = True
+
+        self.prune()
+        if self.dirty:
+            self.save()
+        return stats
+
+    def sync(self, database_path):
+        started = time.perf_counter()
+        stats = {"hit": 0, "hash_hit": 0, "miss": 0, "removed": 0}
+        seen = set()
+
+        for person_name, image_path in iter_face_images(database_path):
+            seen.add(image_path)
+            stats[self.update_file(image_path, person_name)] += 1
+
+        for image_path in list(self.files):
+            if image_path not in seen:
+                del self.files[image_path]
+                stats["removed"] += 1
+                self.dirty = True
+
+        self.prune()
+        if self.dirty:
+            self.save()
+
+        stats["seconds"] = time.perf_counter() - started
+        return stats
+
+    def prune(self):
+        # Drop vectors no longer referenced by any file
+        live = {record[0] for record in self.files.values()}
+        for content_hash in list(self.vectors):
+            if content_hash not in live:
+                del self.vectors[content_hash]
+                self.dirty = True
+
+    def entries(self):
+        """Yield (path, name, encoding) for every image with a face."""
+        for path in sorted(self.files):
+            content_hash, name, _, _ = self.files[path]
+            vector = self.vectors.get(content_hash)
+            if vector is not None:
+                yield path, name, vector
+
+    def encodings_and_names(self):
+        encodings = []
+        names = []
+        for _, name, vector in self.entries():
+            encodings.append(vector)
+            names.append(name)
+        return encodings, names
+
+    def rebuild(self, database_path):
+        self.files = {}
+        self.vectors = {}
+        self.dirty = True
+        return self.sync(database_path)
+
+    def verify(self, database_path, tolerance=1e-4):
+        """Re-hash and re-encode every image and compare against the store."""
+        problems = []
+        checked = 0
+        for person_name, image_path in iter_face_images(database_path):
+            checked += 1
+            record = self.files.get(image_path)
+            if record is None:
+                problems.append((image_path, "missing from store"))
+                continue
+            content_hash, name, _, _ = record
+            if name != person_name:
+                problems.append((image_path, f"stored name {name!r}"))
+            if file_hash(image_path) != content_hash:
+                problems.append((image_path, "content hash changed"))
+                continue
+
+            stored = self.vectors.get(content_hash)
+            fresh = encode_image(image_path)
+            if (stored is None) != (fresh is None):
+                problems.append((image_path, "face presence differs"))
+            elif stored is not None and np.linalg.norm(stored - fresh) > tolerance:
+                problems.append((image_path, "encoding differs"))
+
+        for image_path in self.files:
+            if not os.path.isfile(image_path):
+                problems.append((image_path, "file no longer exists"))
+
+        return checked, problems
+
+
+def print_sync_stats(stats):
+    total = stats["hit"] + stats["hash_hit"] + stats["miss"]
+    hits = stats["hit"] + stats["hash_hit"]
+    rate = 100.0 * hits / total if total else 100.0
+    print(
+        f"Encoding cache: {hits}/{total} hits ({rate:.1f}%), "
+        f"{stats['miss']} encoded, {stats['removed']} removed "
+        f"in {stats['seconds']:.2f}s"
+    )
+
+
+def load_store(database_path, store_path=STORE_PATH):
+    store = EncodingStore(store_path).load()
+    print_sync_stats(store.sync(database_path))
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the face encoding store")
+    parser.add_argument("--faces", default="faces/", help="face database directory")
+    parser.add_argument("--store", default=STORE_PATH, help="encoding store file")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--rebuild", action="store_true", help="re-encode every image")
+    group.add_argument("--verify", action="store_true", help="check store against images")
+    args = parser.parse_args()
+
+    store = EncodingStore(args.store).load()
+    if args.rebuild:
+        print_sync_stats(store.rebuild(args.faces))
+    elif args.verify:
+        checked, problems = store.verify(args.faces)
+        for image_path, problem in problems:
+            print(f"{image_path}: {problem}")
+        print(f"Verified {checked} images, {len(problems)} problems found")
+        raise SystemExit(1 if problems else 0)
+    else:
+        print_sync_stats(store.sync(args.faces))
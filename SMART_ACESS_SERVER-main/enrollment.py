@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import os
+import zipfile
+from datetime import datetime
+
+import aiofiles
+
+from database import gallery_versions, pictures_collection
+from encoding_store import is_face_image
+from gallery_sync import pack_vector
+
+# Uploads are copied to disk this many bytes at a time
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+# Accepted pictures of a bulk enrollment are inserted this many at a time
+BULK_INSERT_BATCH = int(os.getenv("BULK_INSERT_BATCH", 100))
+
+
+def unique_path(directory, filename):
+    stem, extension = os.path.splitext(filename)
+    path = os.path.join(directory, filename)
+    number = 1
+    while os.path.exists(path):
+        path = os.path.join(directory, f"{stem}_{number}{extension}")
+        number += 1
+    return path
+
+
+def enrollment_path(upload_dir, name, filename):
+    person_dir = os.path.join(upload_dir, name)
+    os.makedirs(person_dir, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    return unique_path(person_dir, f"{timestamp}_{os.path.basename(filename)}")
+
+
+def remove_enrolled_file(file_path):
+    os.remove(file_path)
+    person_dir = os.path.dirname(file_path)
+    if not os.listdir(person_dir):
+        os.rmdir(person_dir)
+
+
+def person_name(filename, default=None):
+    # "Jane Doe/1.jpg" enrolls Jane Doe, a bare "jane.jpg" the default name
+    # or else the file name itself
+    parts = [p for p in filename.replace("\\", "/").split("/") if p and p not in (".", "..")]
+    if len(parts) > 1:
+        return parts[-2]
+    if default:
+        return default
+    return os.path.splitext(parts[-1])[0] if parts else None
+
+
+async def save_upload(upload, file_path, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Copy an UploadFile to disk chunk by chunk; returns its sha256."""
+    digest = hashlib.sha256()
+    async with aiofiles.open(file_path, "wb") as out_file:
+        while chunk := await upload.read(chunk_size):
+            digest.update(chunk)
+            await out_file.write(chunk)
+    return digest.hexdigest()
+
+
+def extract_zip(fileobj, upload_dir, default_name=None, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Stream the face images of a zip archive into faces/<name>/.
+
+    Returns (member name, person name, file path, sha256) per saved image.
+    """
+    saved = []
+    with zipfile.ZipFile(fileobj) as archive:
+        for member in archive.infolist():
+            basename = os.path.basename(member.filename)
+            if member.is_dir() or not is_face_image(basename):
+                continue
+            # macOS resource forks
+            if member.filename.startswith("__MACOSX/") or basename.startswith("._"):
+                continue
+            name = person_name(member.filename, default_name)
+            file_path = enrollment_path(upload_dir, name, basename)
+            digest = hashlib.sha256()
+            with archive.open(member) as source, open(file_path, "wb") as target:
+                while chunk := source.read(chunk_size):
+                    digest.update(chunk)
+                    target.write(chunk)
+            saved.append((member.filename, name, file_path, digest.hexdigest()))
+    return saved
+
+
+async def _insert_accepted(job, accepted, user_id, access_level, recognition_service):
+    async with gallery_versions(len(accepted)) as last_version:
+        first_version = last_version - len(accepted) + 1
+        documents = [
+            {
+                "userId": user_id,
+                "name": name,
+                "picture": file_path,
+                "accessLevel": access_level,
+                "encoding": pack_vector(vector),
+                "hash": digest,
+                "version": first_version + i,
+            }
+            for i, ((_, name, file_path, digest), vector) in enumerate(accepted)
+        ]
+        result = await pictures_collection.insert_many(documents)
+
+    picture_ids = [str(picture_id) for picture_id in result.inserted_ids]
+    await recognition_service.add_many(
+        [
+            (picture_id, name, vector)
+            for picture_id, ((_, name, _, _), vector) in zip(picture_ids, accepted)
+        ]
+    )
+    for picture_id, ((filename, name, _, _), _) in zip(picture_ids, accepted):
+        job.record("accepted", file=filename, name=name, picture_id=picture_id)
+
+
+async def enroll_files(job, files, user_id, access_level, recognition_service):
+    """Encode saved files in the recognition pool and enroll those with a
+    face, recording every outcome on ``job``."""
+    hashes = [digest for *_, digest in files]
+    known = {
+        picture["hash"]
+        async for picture in pictures_collection.find({"hash": {"$in": hashes}}, {"hash": 1})
+    }
+
+    pending = []
+    for filename, name, file_path, digest in files:
+        # Already enrolled, or the same image twice in this batch
+        if digest in known:
+            remove_enrolled_file(file_path)
+            job.record("duplicate", file=filename, name=name)
+            continue
+        known.add(digest)
+        pending.append((filename, name, file_path, digest))
+
+    async def encode(item):
+        try:
+            return item, await recognition_service.encode_file(item[2])
+        except Exception as e:
+            print(f"Error encoding {item[0]}: {e}")
+            return item, e
+
+    accepted = []
+    for next_result in asyncio.as_completed([encode(item) for item in pending]):
+        item, vector = await next_result
+        filename, name, file_path, _ = item
+        if vector is None or isinstance(vector, Exception):
+            remove_enrolled_file(file_path)
+            job.record("no_face" if vector is None else "invalid", file=filename, name=name)
+            continue
+        accepted.append((item, vector))
+        if len(accepted) >= BULK_INSERT_BATCH:
+            await _insert_accepted(job, accepted, user_id, access_level, recognition_service)
+            accepted = []
+    if accepted:
+        await _insert_accepted(job, accepted, user_id, access_level, recognition_service)
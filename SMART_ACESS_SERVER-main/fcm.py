@@ -0,0 +1,195 @@
+import asyncio
+import json
+import os
+import time
+from datetime import timezone
+
+import httpx
+from google.auth.transport.requests import Request
+from google.oauth2 import service_account
+
+from metrics import Counter, Gauge, Histogram
+
+FCM_SCOPES = ["https://www.googleapis.com/auth/firebase.messaging"]
+# Refresh the access token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = int(os.getenv("FCM_TOKEN_REFRESH_MARGIN", 300))
+FCM_WORKERS = int(os.getenv("FCM_WORKERS", 4))
+FCM_QUEUE_SIZE = int(os.getenv("FCM_QUEUE_SIZE", 1000))
+FCM_MAX_RETRIES = int(os.getenv("FCM_MAX_RETRIES", 3))
+FCM_TIMEOUT = float(os.getenv("FCM_TIMEOUT", 10))
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+FCM_REQUEST_SECONDS = Histogram("fcm_request_seconds", "FCM send round trips, per attempt")
+FCM_MESSAGES = Counter("fcm_messages_total", "FCM messages by final status", ["status"])
+FCM_QUEUE_DEPTH = Gauge("fcm_queue_depth", "Messages waiting for an FCM worker")
+
+
+def fcm_url(project_id):
+    # FCM_URL can point at a local stub server for testing
+    return os.getenv(
+        "FCM_URL", f"https://fcm.googleapis.com/v1/projects/{project_id}/messages:send"
+    )
+
+
+class AccessTokenCache:
+    """Service-account OAuth token, loaded once and refreshed shortly before
+    it expires instead of on every notification."""
+
+    def __init__(self, service_account_file, scopes=FCM_SCOPES, margin=TOKEN_REFRESH_MARGIN):
+        self.service_account_file = service_account_file
+        self.scopes = scopes
+        self.margin = margin
+        self.credentials = None
+        # FCM_ACCESS_TOKEN skips Google auth entirely (local stub servers)
+        self.static_token = os.getenv("FCM_ACCESS_TOKEN")
+        self.lock = asyncio.Lock()
+        self.refresh_task = None
+
+    def _load_credentials(self):
+        with open(self.service_account_file, "r") as file:
+            service_account_info = json.load(file)
+        return service_account.Credentials.from_service_account_info(
+            service_account_info, scopes=self.scopes
+        )
+
+    def _seconds_left(self):
+        if self.credentials is None or not self.credentials.token:
+            return 0
+        expiry = self.credentials.expiry
+        if expiry is None:
+            return float("inf")
+        return expiry.replace(tzinfo=timezone.utc).timestamp() - time.time()
+
+    async def refresh(self):
+        async with self.lock:
+            loop = asyncio.get_running_loop()
+            if self.credentials is None:
+                self.credentials = await loop.run_in_executor(None, self._load_credentials)
+            # credentials.refresh is a blocking HTTP round trip
+            await loop.run_in_executor(None, self.credentials.refresh, Request())
+            return self.credentials.token
+
+    async def get(self):
+        if self.static_token:
+            return self.static_token
+        if self._seconds_left() > self.margin:
+            return self.credentials.token
+        return await self.refresh()
+
+    async def _refresh_forever(self):
+        while True:
+            try:
+                await asyncio.sleep(max(1, self._seconds_left() - self.margin))
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error refreshing FCM access token: {e}")
+                await asyncio.sleep(30)
+
+    def start(self):
+        if not self.static_token and self.refresh_task is None:
+            self.refresh_task = asyncio.create_task(self._refresh_forever())
+
+    async def stop(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+            self.refresh_task = None
+
+
+class FCMDispatcher:
+    """Sends FCM messages from a bounded queue with a few worker tasks that
+    share one keep-alive HTTP client."""
+
+    def __init__(
+        self,
+        url,
+        token_cache,
+        workers=FCM_WORKERS,
+        queue_size=FCM_QUEUE_SIZE,
+        max_retries=FCM_MAX_RETRIES,
+        timeout=FCM_TIMEOUT,
+    ):
+        self.url = url
+        self.token_cache = token_cache
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.queue = None
+        self.client = None
+        self.tasks = []
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        FCM_QUEUE_DEPTH.set_function(self.queue.qsize)
+        self.client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(
+                max_connections=self.workers, max_keepalive_connections=self.workers
+            ),
+        )
+        self.token_cache.start()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        await self.token_cache.stop()
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def send(self, fcm_token, title, body):
+        """Queue a message and wait for its (status_code, text) result.
+
+        Raises asyncio.QueueFull when the dispatcher is saturated.
+        """
+        message = {
+            "message": {
+                "token": fcm_token,
+                "notification": {
+                    "title": title,
+                    "body": body,
+                },
+            }
+        }
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((message, future))
+        return await future
+
+    async def _post(self, message):
+        for attempt in range(self.max_retries + 1):
+            try:
+                access_token = await self.token_cache.get()
+                with FCM_REQUEST_SECONDS.time():
+                    response = await self.client.post(
+                        self.url,
+                        json=message,
+                        headers={"Authorization": f"Bearer {access_token}"},
+                    )
+            except httpx.TransportError as e:
+                if attempt == self.max_retries:
+                    return 503, str(e)
+            else:
+                if response.status_code == 401 and attempt < self.max_retries:
+                    await self.token_cache.refresh()
+                    continue
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                    return response.status_code, response.text
+            await asyncio.sleep(0.5 * 2**attempt)
+
+    async def _worker(self):
+        while True:
+            message, future = await self.queue.get()
+            try:
+                result = await self._post(message)
+                FCM_MESSAGES.inc(status=result[0])
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,134 @@
+from collections import namedtuple
+
+import numpy as np
+
+from encoding_store import ENCODING_SIZE
+
+# name is None when the best distance is above the tolerance; margin is the
+# distance gap to the second closest identity (inf with a single identity)
+Match = namedtuple("Match", ["name", "distance", "margin"])
+
+
+class Gallery:
+    """All known encodings in one contiguous float32 matrix.
+
+    Rows are grouped by identity so per-person minimum distances can be
+    taken with a single ``np.minimum.reduceat`` over the distance matrix.
+    A Gallery is never modified after construction; reloads build a new one
+    and swap the reference. When ``index`` is set (see ann_index.py),
+    nearest matching goes through the approximate index instead.
+    """
+
+    def __init__(self, encodings, names, paths=None, index=None):
+        names = list(names)
+        paths = list(paths) if paths is not None else [None] * len(names)
+        matrix = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+
+        self.label_names = sorted(set(names))
+        lookup = {name: i for i, name in enumerate(self.label_names)}
+        labels = np.array([lookup[name] for name in names], dtype=np.int32)
+
+        order = np.argsort(labels, kind="stable")
+        self._set_arrays(np.ascontiguousarray(matrix[order]), labels[order])
+        self.paths = [paths[i] for i in order]
+        self.index = index
+
+    def _set_arrays(self, matrix, labels):
+        self.matrix = matrix
+        self.labels = labels
+        self.sq_norms = np.einsum("ij,ij->i", self.matrix, self.matrix)
+        # first row of every identity, used by reduceat
+        self.starts = np.flatnonzero(np.r_[True, self.labels[1:] != self.labels[:-1]])
+        self._centroids = None
+
+    @classmethod
+    def from_arrays(cls, matrix, labels, label_names):
+        """Wrap a matrix whose rows are already grouped by label, without
+        copying it (used for galleries living in shared memory)."""
+        gallery = cls.__new__(cls)
+        gallery.label_names = list(label_names)
+        gallery._set_arrays(matrix, labels)
+        gallery.paths = [None] * len(labels)
+        gallery.index = None
+        return gallery
+
+    @classmethod
+    def from_entries(cls, entries):
+        paths, names, encodings = [], [], []
+        for path, name, vector in entries:
+            paths.append(path)
+            names.append(name)
+            encodings.append(vector)
+        return cls(encodings, names, paths)
+
+    @classmethod
+    def from_store(cls, store):
+        return cls.from_entries(store.entries())
+
+    def __len__(self):
+        return len(self.labels)
+
+    def names(self):
+        return [self.label_names[label] for label in self.labels]
+
+    @property
+    def centroids(self):
+        if self._centroids is None:
+            sums = np.add.reduceat(self.matrix, self.starts, axis=0) if len(self) else self.matrix
+            counts = np.diff(np.r_[self.starts, len(self)])
+            self._centroids = (sums / counts[:, None]).astype(np.float32)
+        return self._centroids
+
+    def distances(self, face_encodings, targets=None):
+        """Euclidean distances, shape (len(face_encodings), len(targets))."""
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        if targets is None:
+            targets, target_norms = self.matrix, self.sq_norms
+        else:
+            target_norms = np.einsum("ij,ij->i", targets, targets)
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+        sq = query_norms[:, None] + target_norms[None, :] - 2.0 * (queries @ targets.T)
+        return np.sqrt(np.maximum(sq, 0.0))
+
+    def identity_distances(self, face_encodings, mode="nearest"):
+        """Per-identity distances, shape (len(face_encodings), len(label_names)).
+
+        ``nearest`` takes the closest enrolled image of every person,
+        ``centroid`` compares against the mean encoding of every person.
+        """
+        if mode == "centroid":
+            return self.distances(face_encodings, self.centroids)
+        if mode != "nearest":
+            raise ValueError(f"Unknown match mode: {mode}")
+        return np.minimum.reduceat(self.distances(face_encodings), self.starts, axis=1)
+
+    def match(self, face_encodings, tolerance=0.6, mode="nearest"):
+        if self.index is not None and mode == "nearest" and len(face_encodings):
+            return self.index.match(face_encodings, tolerance)
+        return self.exact_match(face_encodings, tolerance, mode)
+
+    def exact_match(self, face_encodings, tolerance=0.6, mode="nearest"):
+        count = len(face_encodings)
+        if count == 0:
+            return []
+        if len(self) == 0:
+            return [Match(None, float("inf"), float("inf"))] * count
+
+        per_identity = self.identity_distances(face_encodings, mode)
+        rows = np.arange(count)
+        best = np.argmin(per_identity, axis=1)
+        best_distance = per_identity[rows, best]
+        if per_identity.shape[1] > 1:
+            second = np.partition(per_identity, 1, axis=1)[:, 1]
+            margin = second - best_distance
+        else:
+            margin = np.full(count, np.inf)
+
+        return [
+            Match(
+                self.label_names[best[i]] if best_distance[i] <= tolerance else None,
+                float(best_distance[i]),
+                float(margin[i]),
+            )
+            for i in range(count)
+        ]
@@ -0,0 +1,117 @@
+import base64
+import os
+import threading
+
+import numpy as np
+import requests
+
+from ann_index import index_for
+from encoding_store import ENCODING_SIZE
+from gallery import Gallery
+
+# How often (seconds) camera nodes ask the server for gallery changes
+GALLERY_SYNC_INTERVAL = float(os.getenv("GALLERY_SYNC_INTERVAL", 10))
+# Must match the server's; /gallery/sync refuses callers without it
+NODE_API_KEY = os.getenv("NODE_API_KEY")
+
+
+def pack_vector(vector):
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def unpack_vector(data):
+    return np.frombuffer(data, dtype=np.float32, count=ENCODING_SIZE).copy()
+
+
+def vector_to_text(data):
+    # Vectors travel as base64 float32, a quarter of a JSON float list
+    return base64.b64encode(bytes(data)).decode()
+
+
+def vector_from_text(text):
+    return unpack_vector(base64.b64decode(text))
+
+
+class GalleryReplica:
+    """Enrolled encodings keyed by picture id, kept up to date from
+    ``/gallery/sync`` changes (or from the pictures collection itself on the
+    server)."""
+
+    def __init__(self):
+        # picture id -> (name, float32 vector)
+        self.entries = {}
+        self.version = 0
+
+    def put(self, picture_id, name, vector):
+        self.entries[picture_id] = (name, vector)
+
+    def remove(self, picture_id):
+        return self.entries.pop(picture_id, None) is not None
+
+    def apply(self, changes):
+        """Apply one sync response; returns the picture ids that changed."""
+        changed = set()
+        for picture in changes["upserts"]:
+            self.put(picture["id"], picture["name"], vector_from_text(picture["encoding"]))
+            changed.add(picture["id"])
+        for picture_id in changes["deletes"]:
+            if self.remove(picture_id):
+                changed.add(picture_id)
+        self.version = changes["version"]
+        return changed
+
+    def gallery(self, previous=None, changed=()):
+        ids = list(self.entries)
+        names = [self.entries[picture_id][0] for picture_id in ids]
+        vectors = [self.entries[picture_id][1] for picture_id in ids]
+        # Picture ids take the place of file paths as ANN index keys
+        gallery = Gallery(vectors, names, ids)
+        gallery.index = index_for(gallery, previous.index if previous else None, changed)
+        return gallery
+
+
+class GallerySyncClient:
+    """Polls the server for changed vectors so camera nodes never need the
+    faces/ directory or dlib enrollment of their own.
+
+    ``on_update(gallery, changed_ids)`` is called from the sync thread with a
+    freshly built Gallery whenever something changed.
+    """
+
+    def __init__(self, api_url, on_update, interval=GALLERY_SYNC_INTERVAL):
+        self.url = f"{api_url}/gallery/sync"
+        self.on_update = on_update
+        self.interval = interval
+        self.replica = GalleryReplica()
+        self.gallery = Gallery([], [])
+        self.session = requests.Session()
+        if NODE_API_KEY:
+            self.session.headers["X-Node-Key"] = NODE_API_KEY
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="gallery-sync", daemon=True)
+
+    def pull(self):
+        response = self.session.get(
+            self.url, params={"since": self.replica.version}, timeout=30
+        )
+        response.raise_for_status()
+        changed = self.replica.apply(response.json())
+        if changed:
+            self.gallery = self.replica.gallery(self.gallery, changed)
+            self.on_update(self.gallery, changed)
+        return changed
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join(timeout=5)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.pull()
+            except Exception as e:
+                print(f"Error syncing gallery: {e}")
@@ -0,0 +1,296 @@
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from PIL import Image
+from pymongo.errors import BulkWriteError, PyMongoError
+
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", 20))
+# Flush at least this often (seconds) even if the batch is not full
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", 2))
+HISTORY_QUEUE_SIZE = int(os.getenv("HISTORY_QUEUE_SIZE", 256))
+HISTORY_SPOOL_PATH = os.getenv("HISTORY_SPOOL_PATH", "history_spool.jsonl")
+# How often (seconds) to try replaying spooled records into MongoDB
+HISTORY_REPLAY_INTERVAL = float(os.getenv("HISTORY_REPLAY_INTERVAL", 30))
+# Records MongoDB rejected this many times are moved to the dead-letter file
+HISTORY_MAX_REPLAYS = int(os.getenv("HISTORY_MAX_REPLAYS", 5))
+HISTORY_DEAD_LETTER_PATH = os.getenv("HISTORY_DEAD_LETTER_PATH", "history_dead_letter.jsonl")
+DUPLICATE_KEY = 11000
+
+
+def _to_json(document, attempts=0):
+    document = dict(document)
+    document["_id"] = {"$oid": str(document["_id"])}
+    document["date"] = {"$date": document["date"].isoformat()}
+    if attempts:
+        document["_attempts"] = attempts
+    return json.dumps(document)
+
+
+def _from_json(line):
+    """(document, times MongoDB already rejected it) from a spooled line."""
+    document = json.loads(line)
+    attempts = document.pop("_attempts", 0)
+    document["_id"] = ObjectId(document["_id"]["$oid"])
+    document["date"] = datetime.fromisoformat(document["date"]["$date"])
+    return document, attempts
+
+
+def history_path(history_dir, name, date, record_id):
+    # history/YYYY/MM/DD/<name>_<HHMMSS>_<id>.jpg; the record id keeps two
+    # visits of the same person within one second apart
+    day_dir = os.path.join(history_dir, *date.strftime("%Y %m %d").split())
+    os.makedirs(day_dir, exist_ok=True)
+    return os.path.join(day_dir, f"{name}_{date.strftime('%H%M%S')}_{record_id}.jpg")
+
+
+def _failed_documents(error, documents):
+    # Duplicate keys mean the document already made it into MongoDB
+    return [
+        documents[write_error["index"]]
+        for write_error in error.details.get("writeErrors", [])
+        if write_error.get("code") != DUPLICATE_KEY
+    ]
+
+
+class HistoryWriter:
+    """Write-behind recorder for history images and documents.
+
+    ``submit`` only queues the raw crop; JPEG encoding, file writes and
+    ``insert_many`` happen on the writer thread. Documents that cannot be
+    inserted are appended to a local spool file and replayed later.
+    """
+
+    def __init__(
+        self,
+        collection,
+        history_dir,
+        batch_size=HISTORY_BATCH_SIZE,
+        flush_interval=HISTORY_FLUSH_INTERVAL,
+        queue_size=HISTORY_QUEUE_SIZE,
+        spool_path=HISTORY_SPOOL_PATH,
+        replay_interval=HISTORY_REPLAY_INTERVAL,
+        max_replays=HISTORY_MAX_REPLAYS,
+        dead_letter_path=HISTORY_DEAD_LETTER_PATH,
+    ):
+        self.collection = collection
+        self.history_dir = history_dir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.spool_path = spool_path
+        self.replay_interval = replay_interval
+        self.max_replays = max_replays
+        self.dead_letter_path = dead_letter_path
+        self.last_replay = 0.0
+        self.running = False
+        self.thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            "written": 0,
+            "spooled": 0,
+            "replayed": 0,
+            "dead_lettered": 0,
+            "dropped": 0,
+            "flushes": 0,
+            "last_flush_seconds": 0.0,
+            "max_flush_seconds": 0.0,
+        }
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.thread.join(timeout=30)
+
+    def submit(self, crop, name, status, date=None):
+        """Queue an RGB crop for the history; never blocks the caller."""
+        try:
+            self.queue.put_nowait((crop, name, status, date or datetime.now()))
+            return True
+        except queue.Full:
+            with self.stats_lock:
+                self.stats["dropped"] += 1
+            print(f"History queue full, dropped record for {name}")
+            return False
+
+    def snapshot(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats["queue_depth"] = self.queue.qsize()
+        stats["spool_pending"] = os.path.exists(self.spool_path)
+        return stats
+
+    def _save_image(self, crop, name, date, record_id):
+        file_path = history_path(self.history_dir, name, date, record_id)
+        Image.fromarray(crop).save(file_path)
+        return file_path
+
+    def _next_batch(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while self.running or not self.queue.empty():
+            try:
+                batch = self._next_batch()
+                if batch:
+                    self._flush(batch)
+                if time.monotonic() - self.last_replay >= self.replay_interval:
+                    self.last_replay = time.monotonic()
+                    self._replay()
+            except Exception as e:
+                print(f"Error in history writer: {e}")
+
+    def _flush(self, batch):
+        documents = []
+        for crop, name, status, date in batch:
+            # _id is assigned here so a replayed record is never duplicated
+            record_id = ObjectId()
+            try:
+                file_path = self._save_image(crop, name, date, record_id)
+            except Exception as e:
+                print(f"Error saving history image for {name}: {e}")
+                continue
+            documents.append(
+                {
+                    "_id": record_id,
+                    "name": name,
+                    "image_path": file_path,
+                    "date": date,
+                    "status": status,
+                }
+            )
+        if not documents:
+            return
+
+        started = time.perf_counter()
+        try:
+            self.collection.insert_many(documents, ordered=False)
+            written = len(documents)
+        except BulkWriteError as e:
+            failed = _failed_documents(e, documents)
+            if failed:
+                print(f"{len(failed)} history records rejected by MongoDB, spooling them")
+                self._spool(failed)
+            written = len(documents) - len(failed)
+        except PyMongoError as e:
+            print(f"MongoDB unavailable ({e}), spooling {len(documents)} history records")
+            self._spool(documents)
+            written = 0
+        elapsed = time.perf_counter() - started
+
+        with self.stats_lock:
+            self.stats["written"] += written
+            self.stats["flushes"] += 1
+            self.stats["last_flush_seconds"] = elapsed
+            self.stats["max_flush_seconds"] = max(self.stats["max_flush_seconds"], elapsed)
+        if written:
+            print(
+                f"Flushed {written} history records in {1000 * elapsed:.0f} ms "
+                f"({self.queue.qsize()} queued)"
+            )
+
+    def _spool(self, documents, count=True, attempts=None, path=None):
+        attempts = attempts or {}
+        with open(path or self.spool_path, "a") as f:
+            for document in documents:
+                f.write(_to_json(document, attempts.get(document["_id"], 0)) + "\n")
+        if count:
+            with self.stats_lock:
+                self.stats["spooled"] += len(documents)
+
+    def _take_spool(self):
+        """Move the spool aside for replaying. A replay file left behind by
+        a crash keeps its records, the spool is appended to it."""
+        replay_path = f"{self.spool_path}.replay"
+        if os.path.exists(self.spool_path):
+            if os.path.exists(replay_path):
+                with open(self.spool_path) as src, open(replay_path, "a+") as dst:
+                    # Its last line may have been cut short mid-write
+                    dst.seek(max(dst.tell() - 1, 0))
+                    if dst.read(1) not in ("", "\n"):
+                        dst.write("\n")
+                    shutil.copyfileobj(src, dst)
+                os.remove(self.spool_path)
+            else:
+                os.replace(self.spool_path, replay_path)
+        return replay_path if os.path.exists(replay_path) else None
+
+    def _replay(self):
+        replay_path = self._take_spool()
+        if replay_path is None:
+            return
+        documents, attempts, unreadable = [], {}, []
+        with open(replay_path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    document, tries = _from_json(line)
+                except (ValueError, KeyError, TypeError):
+                    # e.g. the last line of a spool cut short by a crash
+                    unreadable.append(line if line.endswith("\n") else line + "\n")
+                    continue
+                documents.append(document)
+                attempts[document["_id"]] = tries
+        if unreadable:
+            with open(self.dead_letter_path, "a") as f:
+                f.writelines(unreadable)
+
+        replayed = 0
+        rejected = []
+        for start in range(0, len(documents), self.batch_size):
+            chunk = documents[start : start + self.batch_size]
+            try:
+                self.collection.insert_many(chunk, ordered=False)
+            except BulkWriteError as e:
+                failed = _failed_documents(e, chunk)
+                rejected.extend(failed)
+                replayed += len(chunk) - len(failed)
+                continue
+            except PyMongoError as e:
+                # MongoDB being down is not the records' fault, attempts stay
+                print(f"Replaying history spool failed: {e}")
+                self._spool(documents[start:], count=False, attempts=attempts)
+                break
+            replayed += len(chunk)
+
+        # Rejected records (e.g. failing validation) get max_replays tries
+        # before they stop coming back on every replay
+        for document in rejected:
+            attempts[document["_id"]] += 1
+        dead = [d for d in rejected if attempts[d["_id"]] >= self.max_replays]
+        retry = [d for d in rejected if attempts[d["_id"]] < self.max_replays]
+        if retry:
+            self._spool(retry, count=False, attempts=attempts)
+        if dead:
+            self._spool(dead, count=False, attempts=attempts, path=self.dead_letter_path)
+            print(
+                f"{len(dead)} history records rejected {self.max_replays} times, "
+                f"moved to {self.dead_letter_path}"
+            )
+        os.remove(replay_path)
+
+        with self.stats_lock:
+            self.stats["replayed"] += replayed
+            self.stats["dead_lettered"] += len(dead) + len(unreadable)
+        if replayed:
+            print(f"Replayed {replayed} spooled history records")
@@ -0,0 +1,86 @@
+import asyncio
+import os
+import time
+import uuid
+
+# Finished jobs stay queryable for this long (seconds)
+JOB_TTL = float(os.getenv("JOB_TTL", 3600))
+
+
+class Job:
+    """Progress of a long running operation, polled through /jobs/{id}."""
+
+    def __init__(self, kind, total=0):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "pending"
+        self.total = total
+        self.processed = 0
+        self.counts = {}
+        self.results = []
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def record(self, outcome, **result):
+        self.processed += 1
+        self.counts[outcome] = self.counts.get(outcome, 0) + 1
+        if result:
+            self.results.append({"status": outcome, **result})
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "total": self.total,
+            "processed": self.processed,
+            "counts": self.counts,
+            "results": self.results,
+            "error": self.error,
+        }
+
+
+class JobRegistry:
+    """In-memory jobs of this server process; each runs as an asyncio task."""
+
+    def __init__(self, ttl=JOB_TTL):
+        self.ttl = ttl
+        self.jobs = {}
+        self.tasks = set()
+
+    def create(self, kind, total=0):
+        self._prune()
+        job = Job(kind, total)
+        self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def run(self, job, coroutine):
+        task = asyncio.create_task(self._run(job, coroutine))
+        # keep a reference so the task is not garbage collected mid-run
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return job
+
+    async def _run(self, job, coroutine):
+        job.status = "running"
+        try:
+            await coroutine
+            job.status = "done"
+        except Exception as e:
+            print(f"{job.kind} job {job.id} failed: {e}")
+            job.status = "failed"
+            job.error = str(e)
+        job.finished = time.time()
+
+    def _prune(self):
+        now = time.time()
+        for job_id in [
+            job_id
+            for job_id, job in self.jobs.items()
+            if job.finished is not None and now - job.finished > self.ttl
+        ]:
+            del self.jobs[job_id]
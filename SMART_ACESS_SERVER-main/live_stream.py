@@ -0,0 +1,212 @@
+import os
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+
+# 0 disables the live stream
+LIVE_STREAM_PORT = int(os.getenv("LIVE_STREAM_PORT", 0))
+LIVE_STREAM_MAX_FPS = float(os.getenv("LIVE_STREAM_MAX_FPS", 15))
+LIVE_STREAM_MIN_FPS = float(os.getenv("LIVE_STREAM_MIN_FPS", 2))
+LIVE_STREAM_QUALITY = int(os.getenv("LIVE_STREAM_QUALITY", 80))
+LIVE_STREAM_MIN_QUALITY = int(os.getenv("LIVE_STREAM_MIN_QUALITY", 40))
+# Frames wider than this are scaled down before encoding (0 keeps the size)
+LIVE_STREAM_WIDTH = int(os.getenv("LIVE_STREAM_WIDTH", 640))
+# Encoded frames between two frame rate / quality adjustments
+ADAPT_EVERY = 30
+BOUNDARY = "frame"
+# Small socket send buffers make a slow viewer block its own thread (and
+# skip frames) instead of queueing seconds of video in the kernel
+SEND_BUFFER_BYTES = 64 * 1024
+STREAM_PATH = re.compile(r"^/stream(?:/(\d+))?\.mjpg$")
+
+
+class _Channel:
+    def __init__(self, fps, quality):
+        self.condition = threading.Condition()
+        self.frame = None
+        self.frame_id = 0
+        self.jpeg = None
+        self.jpeg_id = 0
+        self.viewers = 0
+        self.fps = fps
+        self.quality = quality
+        # frames delivered to / skipped by viewers since the last adjustment
+        self.delivered = 0
+        self.skipped = 0
+        self.encoded = 0
+        self.encoder = None
+
+
+class LiveStream:
+    """MJPEG stream of the annotated frames over plain HTTP.
+
+    ``publish`` only hands the newest frame over. Each channel has one
+    encoder thread that JPEG-encodes it once for all viewers, at a frame
+    rate and quality that drop when viewers start skipping frames and
+    recover when they keep up. A slow viewer always gets the newest JPEG
+    and never a backlog.
+    """
+
+    def __init__(
+        self,
+        port=LIVE_STREAM_PORT,
+        max_fps=LIVE_STREAM_MAX_FPS,
+        min_fps=LIVE_STREAM_MIN_FPS,
+        quality=LIVE_STREAM_QUALITY,
+        min_quality=LIVE_STREAM_MIN_QUALITY,
+        width=LIVE_STREAM_WIDTH,
+    ):
+        self.max_fps = max_fps
+        self.min_fps = min_fps
+        self.max_quality = quality
+        self.min_quality = min_quality
+        self.width = width
+        self.channels = {}
+        self.lock = threading.Lock()
+        self.running = False
+        self.server = ThreadingHTTPServer(("0.0.0.0", port), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="live-stream", daemon=True
+        )
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+        print(f"Live stream on http://0.0.0.0:{self.server.server_port}/stream.mjpg")
+        return self
+
+    def stop(self):
+        self.running = False
+        self.server.shutdown()
+        for channel in list(self.channels.values()):
+            with channel.condition:
+                channel.condition.notify_all()
+
+    def publish(self, channel_id, frame):
+        channel = self._channel(channel_id)
+        with channel.condition:
+            if channel.viewers:
+                channel.frame = frame
+                channel.frame_id += 1
+                channel.condition.notify_all()
+
+    def has_viewers(self, channel_id):
+        """Whether anyone watches the channel, so callers can skip annotating
+        frames nobody would see."""
+        with self.lock:
+            channel = self.channels.get(channel_id)
+        return channel is not None and channel.viewers > 0
+
+    def _channel(self, channel_id):
+        with self.lock:
+            channel = self.channels.get(channel_id)
+            if channel is None:
+                channel = _Channel(self.max_fps, self.max_quality)
+                channel.encoder = threading.Thread(
+                    target=self._encode_loop,
+                    args=(channel,),
+                    name=f"live-stream-encoder-{channel_id}",
+                    daemon=True,
+                )
+                self.channels[channel_id] = channel
+                channel.encoder.start()
+            return channel
+
+    def _encode_loop(self, channel):
+        last_frame_id = 0
+        while self.running:
+            with channel.condition:
+                channel.condition.wait_for(
+                    lambda: not self.running
+                    or (channel.viewers and channel.frame_id != last_frame_id),
+                    timeout=1,
+                )
+                if not channel.viewers or channel.frame_id == last_frame_id:
+                    continue
+                frame, last_frame_id = channel.frame, channel.frame_id
+                quality = channel.quality
+
+            started = time.monotonic()
+            height, width = frame.shape[:2]
+            if self.width and width > self.width:
+                frame = cv2.resize(frame, (self.width, height * self.width // width))
+            ok, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if ok:
+                with channel.condition:
+                    channel.jpeg = jpeg.tobytes()
+                    channel.jpeg_id += 1
+                    channel.condition.notify_all()
+                    self._adapt(channel)
+            time.sleep(max(0.0, 1.0 / channel.fps - (time.monotonic() - started)))
+
+    def _adapt(self, channel):
+        channel.encoded += 1
+        if channel.encoded < ADAPT_EVERY:
+            return
+        if channel.skipped > 0.1 * max(channel.delivered, 1):
+            channel.fps = max(self.min_fps, channel.fps * 0.75)
+            channel.quality = max(self.min_quality, channel.quality - 10)
+        else:
+            channel.fps = min(self.max_fps, channel.fps * 1.25)
+            channel.quality = min(self.max_quality, channel.quality + 5)
+        channel.encoded = channel.delivered = channel.skipped = 0
+
+    def _serve(self, request, channel_id):
+        channel = self._channel(channel_id)
+        request.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_BYTES)
+        request.send_response(200)
+        request.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={BOUNDARY}")
+        request.send_header("Cache-Control", "no-cache, private")
+        request.end_headers()
+
+        with channel.condition:
+            channel.viewers += 1
+        seen = 0
+        try:
+            while self.running:
+                with channel.condition:
+                    channel.condition.wait_for(
+                        lambda: not self.running or channel.jpeg_id != seen, timeout=5
+                    )
+                    if not self.running:
+                        break
+                    if channel.jpeg_id == seen:
+                        continue
+                    if seen:
+                        channel.skipped += channel.jpeg_id - seen - 1
+                    channel.delivered += 1
+                    jpeg, seen = channel.jpeg, channel.jpeg_id
+                if jpeg is None:
+                    continue
+                request.wfile.write(
+                    f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\n"
+                    f"Content-Length: {len(jpeg)}\r\n\r\n".encode()
+                )
+                request.wfile.write(jpeg)
+                request.wfile.write(b"\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with channel.condition:
+                channel.viewers -= 1
+
+    def _handler_class(self):
+        stream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                match = STREAM_PATH.match(self.path.split("?")[0])
+                if match is None:
+                    self.send_error(404)
+                    return
+                stream._serve(self, int(match.group(1) or 0))
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -1,32 +1,91 @@
+import asyncio
 import os
 import uvicorn
-from typing import List
-import aiofiles
+from contextlib import asynccontextmanager
+from typing import List, Optional
 import socketio
 
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form
+from fastapi import Depends, FastAPI, HTTPException, File, UploadFile, Form, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, EmailStr
 from fastapi.staticfiles import StaticFiles
 from bson import ObjectId
-import requests
-from pymongo import MongoClient
-from fastapi.responses import JSONResponse
-import bcrypt
+from pymongo.errors import DuplicateKeyError
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from datetime import datetime
-import google.auth
-from google.auth.transport.requests import Request
-from google.oauth2 import service_account
-import json
-import jwt
 import shutil
+import zipfile
 
-# Create the FastAPI app
-app = FastAPI()
+# Load .env before the local modules below read their settings
+load_dotenv()
+
+import database  # noqa: E402
+from auth import PasswordHasher, authorize, issue_token, node_access, session_user  # noqa: E402
+from database import (  # noqa: E402
+    gallery_version,
+    gallery_versions,
+    history_collection,
+    notification_counts_collection,
+    pictures_collection,
+    tombstones_collection,
+    users_collection,
+)
+from encoding_store import file_hash, is_face_image  # noqa: E402
+from enrollment import (  # noqa: E402
+    enroll_files,
+    enrollment_path,
+    extract_zip,
+    person_name,
+    remove_enrolled_file,
+    save_upload,
+)
+from fcm import AccessTokenCache, FCMDispatcher, fcm_url  # noqa: E402
+from gallery_sync import pack_vector, vector_to_text  # noqa: E402
+from jobs import JobRegistry  # noqa: E402
+from metrics import CONTENT_TYPE, METRICS_ENABLED, MetricsMiddleware, render  # noqa: E402
+from notification_counts import CountEmitter, counter_store  # noqa: E402
+from pagination import fetch_page, format_date, page_size, stream_json_array  # noqa: E402
+from recognition_service import RECOGNIZE_TOLERANCE, RecognitionService  # noqa: E402
+from retention import HistoryRetention, clear_history  # noqa: E402
+from thumbnails import FORMATS, SIZES, THUMBNAIL_QUALITY, ThumbnailCache  # noqa: E402
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await database.create_indexes()
+    await notification_dispatcher.start()
+    await recognition_service.start()
+    # Startup goes on while the gallery loads; keep the task so it is not
+    # garbage collected and its failure gets reported
+    gallery_task = asyncio.create_task(prepare_gallery())
+    gallery_task.add_done_callback(report_gallery_task)
+    await asyncio.to_thread(thumbnail_cache.load)
+    history_retention.start()
+    yield
+    gallery_task.cancel()
+    await history_retention.stop()
+    thumbnail_cache.shutdown()
+    await recognition_service.stop()
+    await notification_dispatcher.stop()
+    password_hasher.shutdown()
+    database.close()
 
-# Socket.IO setup
-sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*")
+
+# Create the FastAPI app
+app = FastAPI(lifespan=lifespan)
+
+# Socket.IO setup. With several server workers, SOCKETIO_MESSAGE_QUEUE
+# (e.g. redis://localhost:6379/0) lets an emit reach a room whose clients
+# are connected to another worker
+SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE")
+sio = socketio.AsyncServer(
+    async_mode="asgi",
+    cors_allowed_origins="*",
+    client_manager=(
+        socketio.AsyncRedisManager(SOCKETIO_MESSAGE_QUEUE) if SOCKETIO_MESSAGE_QUEUE else None
+    ),
+)
 socket_app = socketio.ASGIApp(sio, app)
 
 # Mount static files
@@ -36,6 +95,50 @@ if not os.path.exists(upload_dir):
 app.mount("/faces", StaticFiles(directory="faces"), name="faces")
 app.mount("/history", StaticFiles(directory="history"), name="history")
 
+# Detection and encoding run in a warm process pool, matching against the
+# gallery of enrolled faces kept in memory
+recognition_service = RecognitionService()
+jobs = JobRegistry()
+password_hasher = PasswordHasher()
+thumbnail_cache = ThumbnailCache()
+history_retention = HistoryRetention()
+
+
+async def backfill_encodings():
+    # Pictures enrolled before encodings were stored at upload time
+    count = 0
+    async for picture in pictures_collection.find(
+        {"encoding": {"$exists": False}}, {"picture": 1}
+    ):
+        try:
+            vector = await recognition_service.encode_file(picture["picture"])
+        except Exception as e:
+            print(f"Could not encode {picture['picture']}: {e}")
+            vector = None
+        async with gallery_versions() as version:
+            await pictures_collection.update_one(
+                {"_id": picture["_id"]},
+                {
+                    "$set": {
+                        "encoding": pack_vector(vector) if vector is not None else None,
+                        "version": version,
+                    }
+                },
+            )
+        count += 1
+    if count:
+        print(f"Stored encodings for {count} previously enrolled pictures")
+
+
+async def prepare_gallery():
+    await backfill_encodings()
+    await recognition_service.load_gallery(pictures_collection)
+
+
+def report_gallery_task(task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Error loading the face gallery: {task.exception()!r}")
+
 # Add CORS middleware to allow cross-origin requests
 app.add_middleware(
     CORSMiddleware,
@@ -45,17 +148,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-load_dotenv()
-MONGO_URI = os.getenv("MONGO_URI")
-client = MongoClient(MONGO_URI)
-
-db = client["CameraDb"]
-users_collection = db["users"]
-pictures_collection = db["pictures"]
-history_collection = db["history"]
+# Request latency and in-flight requests, scraped from /metrics. Each server
+# worker keeps its own numbers, so scrape them one by one
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
 
-# Store notification counts (in production, use a database)
-notification_counts = {}
+notification_counts = counter_store(notification_counts_collection)
+count_emitter = CountEmitter(sio, notification_counts)
 
 
 # Pydantic models
@@ -87,6 +186,8 @@ class NotificationData(BaseModel):
     fcm_token: str
     title: str
     body: str
+    # room whose notification count goes up; the app joins "admin_user_id"
+    user_id: Optional[str] = None
 
 
 class AccessHistoryItem(BaseModel):
@@ -98,62 +199,33 @@ class AccessHistoryItem(BaseModel):
 # Firebase Cloud Messaging credentials
 PROJECT_ID = "smartaccess-3df78"
 SERVICE_ACCOUNT_FILE = "smartaccess-3df78-firebase-adminsdk-fbsvc-7f6ca951c9.json"
+NOTIFICATION_USER_ID = os.getenv("NOTIFICATION_USER_ID", "admin_user_id")
 
 
-def get_access_token():
-    with open(SERVICE_ACCOUNT_FILE, "r") as file:
-        service_account_info = json.load(file)
-
-    scopes = ["https://www.googleapis.com/auth/firebase.messaging"]
-    credentials = service_account.Credentials.from_service_account_info(
-        service_account_info, scopes=scopes
-    )
-
-    credentials.refresh(Request())
-    return credentials.token
+notification_dispatcher = FCMDispatcher(
+    fcm_url(PROJECT_ID), AccessTokenCache(SERVICE_ACCOUNT_FILE)
+)
 
 
 @app.post("/send_notification/")
 async def send_notification(notification: NotificationData):
-    # Get the access token
-    access_token = get_access_token()
-
-    # FCM HTTP v1 API URL
-    url = f"https://fcm.googleapis.com/v1/projects/{PROJECT_ID}/messages:send"
-
-    # Set up headers for the request
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
-
-    # Prepare the message payload
-    message = {
-        "message": {
-            "token": notification.fcm_token,
-            "notification": {
-                "title": notification.title,
-                "body": notification.body,
-            },
-        }
-    }
-
-    # Send the notification via HTTP POST request
-    response = requests.post(url, json=message, headers=headers)
+    try:
+        status_code, text = await notification_dispatcher.send(
+            notification.fcm_token, notification.title, notification.body
+        )
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Notification queue is full")
 
-    # Update notification count and emit Socket.IO event
-    user_id = "blabla"
-    notification_counts[user_id] = notification_counts.get(user_id, 0) + 1
-    await sio.emit(
-        "notification_count",
-        {"user_id": user_id, "count": notification_counts[user_id]},
-    )
+    # Count it for the user and let their room know (coalesced)
+    user_id = notification.user_id or NOTIFICATION_USER_ID
+    await notification_counts.increment(user_id)
+    count_emitter.schedule(user_id)
 
     # Check if the request was successful
-    if response.status_code == 200:
+    if status_code == 200:
         return {"message": "Notification sent successfully"}
     else:
-        return {"error": response.text}
+        return {"error": text}
 
 
 # Socket.IO events
@@ -163,17 +235,22 @@ async def connect(sid, environ):
 
 
 @sio.event
-async def reset_notification_counts(sid):
-    # Reset all notification counts
-    print("reset")
-    global notification_counts
-    notification_counts = {}
-
-    # Emit a confirmation to all clients that the counts have been reset
+async def reset_notification_counts(sid, data=None):
+    # Reset the count of the user this client joined as
+    session = await sio.get_session(sid)
+    user_id = session.get("user_id")
+    if user_id is None:
+        return
+    await notification_counts.reset(user_id)
+
+    # Confirm to the user's clients only
     await sio.emit(
-        "notification_counts_reset", {"message": "Notification counts have been reset."}
+        "notification_counts_reset",
+        {"message": "Notification counts have been reset."},
+        room=user_id,
     )
-    print("Notification counts reset for all users.")
+    await count_emitter.emit_now(user_id)
+    print(f"Notification counts reset for {user_id}.")
 
 
 @sio.event
@@ -184,31 +261,31 @@ async def disconnect(sid):
 @sio.event
 async def join_room(sid, data):
     user_id = data["user_id"]
-    sio.enter_room(sid, user_id)
+    await sio.enter_room(sid, user_id)
+    await sio.save_session(sid, {"user_id": user_id})
     print(f"User {user_id} joined room")
-    # Send current count when user joins
-    await sio.emit(
-        "notification_count",
-        {"user_id": user_id, "count": notification_counts.get(user_id, 0)},
-        room=user_id,
-    )
+    # Send current count to this client only when it joins
+    await count_emitter.emit_now(user_id, room=sid)
     print("user connected ", data)
 
 
 # SignUp route
 @app.post("/register/")
 async def signup_user(user: SignUp):
-    if users_collection.find_one({"email": user.email}):
+    if await users_collection.find_one({"email": user.email}):
         raise HTTPException(status_code=400, detail="Email already registered")
 
-    hashed_password = bcrypt.hashpw(user.password.encode("utf-8"), bcrypt.gensalt())
+    hashed_password = await password_hasher.hash(user.password)
 
     user_data = {
         "username": user.username,
         "email": user.email,
         "password": hashed_password,
     }
-    users_collection.insert_one(user_data)
+    try:
+        await users_collection.insert_one(user_data)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
 
     return {"message": "User registered successfully"}
 
@@ -216,18 +293,22 @@ async def signup_user(user: SignUp):
 # SignIn route
 @app.post("/signin/")
 async def signin_user(user: SignIn):
-    existing_user = users_collection.find_one({"email": user.email})
+    existing_user = await users_collection.find_one({"email": user.email})
 
     if not existing_user:
         raise HTTPException(status_code=400, detail="Email not found")
 
-    if not bcrypt.checkpw(user.password.encode("utf-8"), existing_user["password"]):
+    if not await password_hasher.check(user.password, existing_user["password"]):
         raise HTTPException(status_code=400, detail="Incorrect password")
 
+    # Later requests send this as "Authorization: Bearer <token>" and are
+    # verified by signature only, without another bcrypt round
+    user_id = str(existing_user["_id"])
     return {
         "message": "Login successful",
-        "user_id": str(existing_user["_id"]),
+        "user_id": user_id,
         "username": existing_user.get("username", "Guest"),
+        "token": issue_token(user_id),
     }
 
 
@@ -250,43 +331,44 @@ async def upload_image(
     name: str = Form(...),
     accessLevel: str = Form(...),
 ):
-    print("image:", image)
-    print("imageUrl:", imageUrl)
-    print("userId:", userId)
-    print("name:", name)
-    print("accessLevel:", accessLevel)
-
-    person_dir = os.path.join(upload_dir, name)
-    os.makedirs(person_dir, exist_ok=True)
-
     try:
         file_path = None
 
         if image:
-            filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{image.filename}"
-            file_path = os.path.join(person_dir, filename)
-
-            async with aiofiles.open(file_path, "wb") as out_file:
-                content = await image.read()
-                await out_file.write(content)
+            file_path = enrollment_path(upload_dir, name, image.filename)
+            digest = await save_upload(image, file_path)
 
         elif imageUrl:
             local_image_path = imageUrl[imageUrl.find("history/") :]
-            file_path = copy_file(local_image_path, person_dir)
+            file_path = copy_file(local_image_path, os.path.join(upload_dir, name))
+            digest = await asyncio.to_thread(file_hash, file_path)
 
         else:
             return JSONResponse(
                 content={"error": "No image or imageUrl provided"}, status_code=400
             )
 
+        # Encode once here, camera nodes only ever receive the vector
+        vector = await recognition_service.encode_file(file_path)
+        if vector is None:
+            remove_enrolled_file(file_path)
+            return JSONResponse(
+                content={"error": "No face found in the image"}, status_code=400
+            )
+
         picture_data = {
             "userId": userId,
             "name": name,
             "picture": file_path,
             "accessLevel": accessLevel,
+            "encoding": pack_vector(vector),
+            "hash": digest,
         }
 
-        pictures_collection.insert_one(picture_data)
+        async with gallery_versions() as version:
+            picture_data["version"] = version
+            result = await pictures_collection.insert_one(picture_data)
+        await recognition_service.add(str(result.inserted_id), name, vector)
 
         return JSONResponse(
             content={
@@ -302,28 +384,223 @@ async def upload_image(
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 
-@app.get("/pictures/{user_id}")
-async def get_user_pictures(user_id: str):
+@app.post("/recognize")
+async def recognize_faces(
+    images: List[UploadFile] = File(...),
+    tolerance: float = Form(RECOGNIZE_TOLERANCE),
+):
+    if recognition_service.gallery is None:
+        raise HTTPException(status_code=503, detail="Face gallery is still loading")
+
+    try:
+        contents = [await image.read() for image in images]
+        # Images of concurrent requests are batched together by the service
+        results = await asyncio.gather(
+            *(recognition_service.recognize(content, tolerance) for content in contents)
+        )
+        return {
+            "results": [
+                {"filename": image.filename, **result}
+                for image, result in zip(images, results)
+            ]
+        }
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+
+@app.post("/upload/bulk", status_code=202)
+async def bulk_upload(
+    files: List[UploadFile] = File(...),
+    userId: str = Form(...),
+    accessLevel: str = Form(...),
+    name: Optional[str] = Form(None),
+):
+    # Zip archives and images can be mixed. Every image is streamed to
+    # faces/<name>/ here; encoding and enrollment run as a job whose
+    # progress and per-file report are polled from /jobs/{job_id}
+    saved, skipped = [], []
+    try:
+        for upload in files:
+            if upload.filename.lower().endswith(".zip"):
+                saved += await asyncio.to_thread(extract_zip, upload.file, upload_dir, name)
+            elif is_face_image(upload.filename):
+                person = person_name(upload.filename, name)
+                file_path = enrollment_path(upload_dir, person, upload.filename)
+                digest = await save_upload(upload, file_path)
+                saved.append((upload.filename, person, file_path, digest))
+            else:
+                skipped.append(upload.filename)
+    except Exception as e:
+        for _, _, file_path, _ in saved:
+            remove_enrolled_file(file_path)
+        status_code = 400 if isinstance(e, zipfile.BadZipFile) else 500
+        return JSONResponse(content={"error": str(e)}, status_code=status_code)
+
+    if not saved:
+        return JSONResponse(content={"error": "No images found"}, status_code=400)
+
+    job = jobs.create("bulk_enrollment", total=len(saved))
+    jobs.run(job, enroll_files(job, saved, userId, accessLevel, recognition_service))
+    return {
+        "message": f"Enrolling {len(saved)} images",
+        "job_id": job.id,
+        "status_url": f"/jobs/{job.id}",
+        "skipped": skipped,
+    }
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return Response(render(), media_type=CONTENT_TYPE)
+
+
+PICTURE_FIELDS = {"userId": 1, "name": 1, "picture": 1, "accessLevel": 1}
+
+
+def picture_item(picture):
+    picture["_id"] = str(picture["_id"])
+    return picture
+
+
+IMAGE_ROOTS = {"faces": upload_dir, "history": "history"}
+THUMBNAIL_MAX_AGE = int(os.getenv("THUMBNAIL_MAX_AGE", 86400))
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+@app.get("/images/{root}/{image_path:path}")
+async def get_image_derivative(
+    root: str,
+    image_path: str,
+    request: Request,
+    size: str = "thumb",
+    format: str = "jpeg",
+    quality: int = THUMBNAIL_QUALITY,
+):
+    # Resized copies of /faces and /history images for list views
+    if root not in IMAGE_ROOTS:
+        raise HTTPException(status_code=404, detail="Image not found")
+    if size not in SIZES or format not in FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"size must be one of {sorted(SIZES)}, format one of {sorted(FORMATS)}",
+        )
+    quality = max(1, min(quality, 95))
+
+    base_dir = os.path.realpath(IMAGE_ROOTS[root])
+    source_path = os.path.realpath(os.path.join(base_dir, image_path))
+    if not source_path.startswith(base_dir + os.sep) or not os.path.isfile(source_path):
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    key = thumbnail_cache.cache_key(source_path, SIZES[size], format, quality)
+    headers = {"ETag": f'"{key}"', "Cache-Control": f"public, max-age={THUMBNAIL_MAX_AGE}"}
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
     try:
-        pictures = list(pictures_collection.find({"userId": user_id}))
+        data = await thumbnail_cache.get(source_path, key, SIZES[size], format, quality)
+    except OSError as e:
+        return JSONResponse(content={"error": f"Cannot read image: {e}"}, status_code=415)
+    return Response(content=data, media_type=FORMATS[format][1], headers=headers)
 
-        for picture in pictures:
-            picture["_id"] = str(picture["_id"])
 
+@app.get("/pictures/{user_id}")
+async def get_user_pictures(
+    user_id: str,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    session_user_id: Optional[str] = Depends(session_user),
+):
+    authorize(user_id, session_user_id)
+    # Without a limit every picture is streamed, with one a page is returned
+    # together with the cursor of the next page
+    query = {"userId": user_id}
+    try:
+        if limit is None and cursor is None:
+            return StreamingResponse(
+                stream_json_array(
+                    pictures_collection,
+                    query,
+                    PICTURE_FIELDS,
+                    picture_item,
+                    prefix='{"message": "Pictures retrieved successfully", "pictures": ',
+                    suffix="}",
+                ),
+                media_type="application/json",
+            )
+
+        pictures, next_cursor = await fetch_page(
+            pictures_collection, query, PICTURE_FIELDS, page_size(limit), cursor
+        )
         return JSONResponse(
             content={
                 "message": "Pictures retrieved successfully",
-                "pictures": pictures,
+                "pictures": [picture_item(picture) for picture in pictures],
+                "next_cursor": next_cursor,
             }
         )
+    except HTTPException:
+        raise
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 
+async def delete_picture_record(picture_id):
+    # The tombstone tells syncing camera nodes to drop the vector
+    async with gallery_versions() as version:
+        result = await pictures_collection.delete_one({"_id": ObjectId(picture_id)})
+        if result.deleted_count:
+            await tombstones_collection.insert_one({"pictureId": picture_id, "version": version})
+    await recognition_service.remove(picture_id)
+    return result
+
+
+@app.get("/gallery/sync", dependencies=[Depends(node_access)])
+async def sync_gallery(since: int = 0):
+    # Vectors added and pictures deleted after version `since`; camera nodes
+    # pass back the returned version on their next call
+    version = await gallery_version()
+    query = {"version": {"$gt": since, "$lte": version}}
+
+    upserts = [
+        {
+            "id": str(picture["_id"]),
+            "name": picture["name"],
+            "encoding": vector_to_text(picture["encoding"]),
+        }
+        async for picture in pictures_collection.find(
+            {**query, "encoding": {"$ne": None}}, {"name": 1, "encoding": 1}
+        )
+    ]
+    # A full sync starts from an empty gallery, nothing to delete
+    deletes = []
+    if since:
+        deletes = [
+            tombstone["pictureId"]
+            async for tombstone in tombstones_collection.find(query, {"pictureId": 1})
+        ]
+    return {"version": version, "upserts": upserts, "deletes": deletes}
+
+
 @app.delete("/pictures/{picture_id}")
 async def delete_picture(picture_id: str):
     try:
-        picture = pictures_collection.find_one({"_id": ObjectId(picture_id)})
+        picture = await pictures_collection.find_one({"_id": ObjectId(picture_id)})
 
         if not picture:
             return JSONResponse(
@@ -339,7 +616,7 @@ async def delete_picture(picture_id: str):
 
         # If the file doesn't exist, just delete the record from MongoDB
         if not os.path.exists(file_path):
-            result = pictures_collection.delete_one({"_id": ObjectId(picture_id)})
+            result = await delete_picture_record(picture_id)
 
             if result.deleted_count == 0:
                 return JSONResponse(
@@ -361,7 +638,7 @@ async def delete_picture(picture_id: str):
             shutil.rmtree(directory)
 
         # Finally, delete the record from MongoDB
-        result = pictures_collection.delete_one({"_id": ObjectId(picture_id)})
+        result = await delete_picture_record(picture_id)
 
         if result.deleted_count == 0:
             return JSONResponse(
@@ -379,20 +656,60 @@ async def delete_picture(picture_id: str):
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 
+USER_HISTORY_FIELDS = {
+    "userId": 1,
+    "registered": 1,
+    "timestamp": 1,
+    "name": 1,
+    "image_path": 1,
+    "date": 1,
+    "status": 1,
+}
+
+
+def user_history_item(entry):
+    entry["_id"] = str(entry["_id"])
+    for field in ("timestamp", "date"):
+        if field in entry:
+            entry[field] = format_date(entry[field])
+    return entry
+
+
 @app.get("/history/{user_id}")
-async def get_user_history(user_id: str):
+async def get_user_history(
+    user_id: str,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    session_user_id: Optional[str] = Depends(session_user),
+):
+    authorize(user_id, session_user_id)
+    query = {"userId": user_id}
     try:
-        history = list(history_collection.find({"userId": user_id}))
-
-        for entry in history:
-            entry["_id"] = str(entry["_id"])
+        if limit is None and cursor is None:
+            return StreamingResponse(
+                stream_json_array(
+                    history_collection,
+                    query,
+                    USER_HISTORY_FIELDS,
+                    user_history_item,
+                    prefix='{"message": "History retrieved successfully", "history": ',
+                    suffix="}",
+                ),
+                media_type="application/json",
+            )
 
+        history, next_cursor = await fetch_page(
+            history_collection, query, USER_HISTORY_FIELDS, page_size(limit), cursor
+        )
         return JSONResponse(
             content={
                 "message": "History retrieved successfully",
-                "history": history,
+                "history": [user_history_item(entry) for entry in history],
+                "next_cursor": next_cursor,
             }
         )
+    except HTTPException:
+        raise
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
@@ -410,8 +727,7 @@ async def add_history(
         )
 
         history_dict = history_entry.dict()
-        history_collection = db["history"]
-        result = history_collection.insert_one(history_dict)
+        result = await history_collection.insert_one(history_dict)
 
         return JSONResponse(
             content={
@@ -425,28 +741,70 @@ async def add_history(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+ACCESS_HISTORY_FIELDS = {"_id": 1, "name": 1, "date": 1, "status": 1, "image_path": 1}
+
+
+def access_history_item(record):
+    return {
+        "user": record.get("name", "Unknown User"),
+        "time": format_date(record.get("date")),
+        "status": record.get("status", False),
+        "image_path": record.get("image_path", ""),
+    }
+
+
 @app.get("/access-history")
-async def get_access_history():
+async def get_access_history(
+    response: Response,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    status: Optional[bool] = None,
+    name: Optional[str] = None,
+):
+    # Newest first, sorted by MongoDB. Without a limit the whole (filtered)
+    # history is streamed; with one, the next page cursor is returned in the
+    # X-Next-Cursor header so the response body stays a plain list
+    query = {}
+    if start is not None or end is not None:
+        query["date"] = {}
+        if start is not None:
+            query["date"]["$gte"] = start
+        if end is not None:
+            query["date"]["$lt"] = end
+    if status is not None:
+        query["status"] = status
+    if name is not None:
+        query["name"] = name
+
     try:
-        records = list(history_collection.find())
-
-        history_data = [
-            {
-                "user": record.get("name", "Unknown User"),
-                "time": (
-                    record["date"].strftime("%Y-%m-%d %H:%M:%S")
-                    if isinstance(record["date"], datetime)
-                    else record["date"]
+        if limit is None and cursor is None:
+            return StreamingResponse(
+                stream_json_array(
+                    history_collection,
+                    query,
+                    ACCESS_HISTORY_FIELDS,
+                    access_history_item,
+                    field="date",
                 ),
-                "status": record.get("status", False),
-                "image_path": record.get("image_path", ""),
-            }
-            for record in records
-        ]
-        history_data.reverse()
+                media_type="application/json",
+            )
 
-        return history_data
+        records, next_cursor = await fetch_page(
+            history_collection,
+            query,
+            ACCESS_HISTORY_FIELDS,
+            page_size(limit),
+            cursor,
+            field="date",
+        )
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return [access_history_item(record) for record in records]
 
+    except HTTPException:
+        raise
     except Exception as e:
         return JSONResponse(
             content={"error": f"Failed to fetch access history: {str(e)}"},
@@ -454,47 +812,18 @@ async def get_access_history():
         )
 
 
-def delete_files_in_batches(directory, batch_size=50):
-    try:
-        files = os.listdir(directory)
-        total_files = len(files)
-
-        # Process files in batches
-        for i in range(0, total_files, batch_size):
-            batch_files = files[i : i + batch_size]
-            for file in batch_files:
-                file_path = os.path.join(directory, file)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-
-        return {
-            "message": f"Deleted {total_files} files from {directory} successfully."
-        }
-    except Exception as e:
-        return {"error": f"Failed to delete files: {str(e)}"}
-
-
 @app.delete("/historyDelete")
-async def clear_history():
-    try:
-        # Delete all documents from the MongoDB collection
-        result = history_collection.delete_many({})
-
-        # Delete all files in the 'history' directory
-        history_dir = "history"
-        if os.path.exists(history_dir):
-            for file in os.listdir(history_dir):
-                file_path = os.path.join(history_dir, file)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-
-        return {
-            "status": "success",
-            "deleted_count": result.deleted_count,
-            "message": "History directory cleared",
-        }
-    except Exception as e:
-        return {"error": f"An error occurred during history deletion: {str(e)}"}
+async def clear_all_history():
+    # Deleting can take a while on a large history, so it runs as a job;
+    # 200 (not 202) keeps existing clients that check for it working
+    job = jobs.create("history_purge")
+    jobs.run(job, clear_history(job))
+    return {
+        "status": "success",
+        "message": "History deletion started",
+        "job_id": job.id,
+        "status_url": f"/jobs/{job.id}",
+    }
 
 
 # Mount the Socket.IO app
@@ -0,0 +1,115 @@
+import os
+import time
+
+import cv2
+import numpy as np
+
+# "0" runs face detection on every frame
+MOTION_GATE = os.getenv("MOTION_GATE", "1") == "1"
+# Frames are scaled down to this width before they are compared
+MOTION_WIDTH = int(os.getenv("MOTION_WIDTH", 160))
+# Grey level difference (0-255) for a pixel to count as changed
+MOTION_PIXEL_THRESHOLD = int(os.getenv("MOTION_PIXEL_THRESHOLD", 25))
+# Share of the watched area that must change to count as motion, lower is
+# more sensitive
+MOTION_SENSITIVITY = float(os.getenv("MOTION_SENSITIVITY", 0.01))
+# How quickly (0-1 per frame) the background follows lighting changes
+MOTION_BACKGROUND_RATE = float(os.getenv("MOTION_BACKGROUND_RATE", 0.05))
+# Let a frame through at least this often (seconds) even without motion
+MOTION_FORCE_INTERVAL = float(os.getenv("MOTION_FORCE_INTERVAL", 5))
+# Watched area, e.g. the doorway: "left,top,right,bottom" rectangles in
+# fractions of the frame separated by ";", and/or a mask image whose white
+# pixels are watched. Everything is watched when neither is set
+MOTION_ROI = os.getenv("MOTION_ROI", "")
+MOTION_MASK_PATH = os.getenv("MOTION_MASK_PATH")
+
+
+def parse_roi(text):
+    rectangles = []
+    for part in text.split(";"):
+        if part.strip():
+            left, top, right, bottom = (float(value) for value in part.split(","))
+            rectangles.append((left, top, right, bottom))
+    return rectangles
+
+
+class MotionGate:
+    """Decides whether a frame is worth running face detection on.
+
+    Each frame is shrunk to MOTION_WIDTH, turned grey and compared with a
+    running average of the previous ones, so comparing costs a tiny
+    fraction of a HOG pass. A frame passes when enough of the watched area
+    changed, or when nothing passed for ``force_interval`` seconds.
+    """
+
+    def __init__(
+        self,
+        sensitivity=MOTION_SENSITIVITY,
+        pixel_threshold=MOTION_PIXEL_THRESHOLD,
+        width=MOTION_WIDTH,
+        background_rate=MOTION_BACKGROUND_RATE,
+        force_interval=MOTION_FORCE_INTERVAL,
+        roi=MOTION_ROI,
+        mask_path=MOTION_MASK_PATH,
+    ):
+        self.sensitivity = sensitivity
+        self.pixel_threshold = pixel_threshold
+        self.width = width
+        self.background_rate = background_rate
+        self.force_interval = force_interval
+        self.rectangles = parse_roi(roi) if isinstance(roi, str) else list(roi)
+        self.mask_path = mask_path
+        self.background = None
+        self.mask = None
+        self.area = 0
+        self.last_pass = None
+        # share of the watched area that changed in the last frame
+        self.motion = 0.0
+
+    def _small_gray(self, frame):
+        height, width = frame.shape[:2]
+        if width > self.width:
+            size = (self.width, max(1, height * self.width // width))
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        # Sensor noise would otherwise read as motion in dim light
+        return cv2.GaussianBlur(gray, (5, 5), 0)
+
+    def _build_mask(self, shape):
+        if not self.rectangles and not self.mask_path:
+            return None
+        height, width = shape
+        mask = np.zeros(shape, dtype=bool)
+        for left, top, right, bottom in self.rectangles:
+            rows = slice(int(top * height), int(bottom * height))
+            columns = slice(int(left * width), int(right * width))
+            mask[rows, columns] = True
+        if self.mask_path:
+            image = cv2.imread(self.mask_path, cv2.IMREAD_GRAYSCALE)
+            if image is None:
+                raise ValueError(f"Could not read motion mask {self.mask_path}")
+            mask |= cv2.resize(image, (width, height), interpolation=cv2.INTER_NEAREST) > 127
+        return mask
+
+    def update(self, frame, now=None):
+        """Feed the next BGR frame; True when it should go to detection."""
+        now = time.monotonic() if now is None else now
+        gray = self._small_gray(frame)
+        if self.background is None or self.background.shape != gray.shape:
+            # First frame (or a resolution change) starts a new background
+            self.background = gray.astype(np.float32)
+            self.mask = self._build_mask(gray.shape)
+            self.area = gray.size if self.mask is None else int(np.count_nonzero(self.mask))
+            self.last_pass = now
+            return True
+
+        changed = cv2.absdiff(gray, cv2.convertScaleAbs(self.background)) > self.pixel_threshold
+        if self.mask is not None:
+            changed &= self.mask
+        self.motion = np.count_nonzero(changed) / max(self.area, 1)
+        cv2.accumulateWeighted(gray, self.background, self.background_rate)
+
+        if self.motion >= self.sensitivity or now - self.last_pass >= self.force_interval:
+            self.last_pass = now
+            return True
+        return False
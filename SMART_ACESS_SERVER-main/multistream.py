@@ -0,0 +1,141 @@
+import multiprocessing
+import os
+import time
+from collections import deque
+
+import cv2
+import face_recognition
+
+from budget import QualityGate
+from pipeline import LatestFrameGrabber
+from shared_gallery import SharedGalleryReader
+from tracking import DETECTION_SCALE, detect_faces
+
+STREAM_WORKERS = int(os.getenv("STREAM_WORKERS", os.cpu_count() or 1))
+
+_reader = None
+_quality_gate = QualityGate()
+
+
+def parse_source(source):
+    # "0", "1"... are device indices, anything else is a URL or file path
+    return int(source) if str(source).isdigit() else source
+
+
+def init_worker(gallery_name):
+    global _reader
+    _reader = SharedGalleryReader(gallery_name)
+
+
+def worker_gallery():
+    """The newest shared gallery, in a pool process set up by init_worker."""
+    return _reader.current()
+
+
+def recognize_frame(task):
+    """Runs in a pool process: detect, encode and match one frame against
+    the shared gallery. Faces failing the quality gate are left out."""
+    stream, frame_id, rgb_frame, tolerance, mode = task
+    boxes = detect_faces(rgb_frame, DETECTION_SCALE)
+    boxes = [box for box in boxes if _quality_gate.check(rgb_frame, box) is None]
+    encodings = face_recognition.face_encodings(rgb_frame, boxes)
+    matches = worker_gallery().match(encodings, tolerance=tolerance, mode=mode)
+    return stream, frame_id, boxes, encodings, matches
+
+
+class MultiStreamRunner:
+    """Captures several sources on threads and recognizes their frames in a
+    process pool whose workers all map the same shared gallery.
+
+    ``on_result(stream, rgb_frame, frame_id, boxes, encodings, matches)`` is
+    called on the main thread for every recognized frame and returns the
+    (box, match) pairs to draw; ``on_tick()`` runs once per loop iteration.
+    Annotated frames go to ``on_frame(stream, frame)`` while
+    ``is_watched(stream)`` holds and, unless ``headless``, to an imshow
+    window per stream. ``should_process(stream, frame)`` may keep a frame
+    out of the pool, e.g. while nothing moves.
+    """
+
+    def __init__(self, sources, gallery_name, on_result, on_tick=None, workers=STREAM_WORKERS,
+                 tolerance=0.7, mode="nearest", on_frame=None, headless=False,
+                 should_process=None, is_watched=None):
+        self.sources = [parse_source(source) for source in sources]
+        self.gallery_name = gallery_name
+        self.on_result = on_result
+        self.on_tick = on_tick
+        self.workers = max(1, workers)
+        self.tolerance = tolerance
+        self.mode = mode
+        self.on_frame = on_frame
+        self.headless = headless
+        self.should_process = should_process
+        self.is_watched = is_watched
+        # frames of one stream allowed in the pool at once
+        self.per_stream = max(1, self.workers // len(self.sources))
+
+    def run(self):
+        # Spawned, not forked: the camera node already runs capture, history,
+        # metrics and stream threads, and a fork taken while one of them holds
+        # a lock leaves that lock held forever in the worker
+        pool = multiprocessing.get_context("spawn").Pool(
+            self.workers, initializer=init_worker, initargs=(self.gallery_name,)
+        )
+        grabbers = [LatestFrameGrabber(source).start() for source in self.sources]
+        in_flight = [deque() for _ in self.sources]
+        last_ids = [0] * len(self.sources)
+        faces = [[] for _ in self.sources]
+
+        try:
+            while True:
+                for stream, grabber in enumerate(grabbers):
+                    pending = in_flight[stream]
+                    while pending and pending[0][1].ready():
+                        rgb_frame, result = pending.popleft()
+                        _, frame_id, boxes, encodings, matches = result.get()
+                        faces[stream] = self.on_result(
+                            stream, rgb_frame, frame_id, boxes, encodings, matches
+                        )
+
+                    frame_id, frame = grabber.read(last_ids[stream], timeout=0)
+                    if frame is None:
+                        continue
+                    last_ids[stream] = frame_id
+
+                    # Frames arriving while the stream's slots are busy are dropped
+                    wanted = self.should_process is None or self.should_process(stream, frame)
+                    if wanted and len(pending) < self.per_stream:
+                        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                        task = (stream, frame_id, rgb_frame, self.tolerance, self.mode)
+                        pending.append((rgb_frame, pool.apply_async(recognize_frame, (task,))))
+
+                    watched = self.on_frame is not None and (
+                        self.is_watched is None or self.is_watched(stream)
+                    )
+                    if self.headless and not watched:
+                        continue
+                    display = frame.copy()
+                    for (top, right, bottom, left), name in faces[stream]:
+                        cv2.rectangle(display, (left, top), (right, bottom), (0, 255, 0), 2)
+                        cv2.putText(
+                            display, name, (left, top - 10),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2,
+                        )
+                    if watched:
+                        self.on_frame(stream, display)
+                    if not self.headless:
+                        cv2.imshow(f"Face Recognition {stream}", display)
+
+                if self.on_tick is not None:
+                    self.on_tick()
+                if all(grabber.failed for grabber in grabbers):
+                    break
+                if self.headless:
+                    # stands in for waitKey's pause, stop with Ctrl+C
+                    time.sleep(0.001)
+                elif cv2.waitKey(1) & 0xFF == 27:
+                    break
+        finally:
+            for grabber in grabbers:
+                grabber.stop()
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,85 @@
+import asyncio
+import os
+
+from pymongo import ReturnDocument
+
+# "mongo" shares counts between all server workers, "local" keeps them in
+# this process only (single worker setups and development)
+NOTIFICATION_COUNTER_STORE = os.getenv("NOTIFICATION_COUNTER_STORE", "mongo")
+# Count updates of one user within this window are sent as a single emit
+NOTIFICATION_EMIT_WINDOW_MS = float(os.getenv("NOTIFICATION_EMIT_WINDOW_MS", 500))
+
+
+class MongoCounterStore:
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def increment(self, user_id):
+        counter = await self.collection.find_one_and_update(
+            {"_id": user_id},
+            {"$inc": {"count": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return counter["count"]
+
+    async def get(self, user_id):
+        counter = await self.collection.find_one({"_id": user_id})
+        return counter["count"] if counter else 0
+
+    async def reset(self, user_id):
+        await self.collection.delete_one({"_id": user_id})
+
+
+class LocalCounterStore:
+    def __init__(self):
+        self.counts = {}
+
+    async def increment(self, user_id):
+        self.counts[user_id] = self.counts.get(user_id, 0) + 1
+        return self.counts[user_id]
+
+    async def get(self, user_id):
+        return self.counts.get(user_id, 0)
+
+    async def reset(self, user_id):
+        self.counts.pop(user_id, None)
+
+
+def counter_store(collection):
+    if NOTIFICATION_COUNTER_STORE == "local":
+        return LocalCounterStore()
+    return MongoCounterStore(collection)
+
+
+class CountEmitter:
+    """Sends ``notification_count`` to a user's room at most once per
+    window; the emit carries the count as it is when the window closes."""
+
+    def __init__(self, sio, store, window_ms=NOTIFICATION_EMIT_WINDOW_MS):
+        self.sio = sio
+        self.store = store
+        self.window = window_ms / 1000.0
+        self.pending = {}
+
+    def schedule(self, user_id):
+        if user_id not in self.pending:
+            self.pending[user_id] = asyncio.create_task(self._emit_later(user_id))
+
+    async def emit_now(self, user_id, room=None):
+        count = await self.store.get(user_id)
+        await self.sio.emit(
+            "notification_count",
+            {"user_id": user_id, "count": count},
+            room=room or user_id,
+        )
+
+    async def _emit_later(self, user_id):
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            del self.pending[user_id]
+        try:
+            await self.emit_now(user_id)
+        except Exception as e:
+            print(f"Error emitting notification count for {user_id}: {e}")
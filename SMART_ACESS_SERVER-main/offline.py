@@ -0,0 +1,344 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import cv2
+import face_recognition
+import numpy as np
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+# Load .env before the local modules below read their settings
+load_dotenv()
+
+from encoding_store import STORE_PATH, is_face_image, load_store  # noqa: E402
+from gallery import Gallery  # noqa: E402
+from history_writer import history_path  # noqa: E402
+from multistream import init_worker, worker_gallery  # noqa: E402
+from shared_gallery import SharedGalleryPublisher  # noqa: E402
+from tracking import detect_faces  # noqa: E402
+from visits import VISIT_TIMEOUT  # noqa: E402
+
+OFFLINE_WORKERS = int(os.getenv("OFFLINE_WORKERS", os.cpu_count() or 1))
+# Seconds of video per pool task; shorter chunks spread better over the
+# workers, longer ones seek less
+OFFLINE_CHUNK_SECONDS = float(os.getenv("OFFLINE_CHUNK_SECONDS", 60))
+OFFLINE_CHUNK_IMAGES = int(os.getenv("OFFLINE_CHUNK_IMAGES", 32))
+OFFLINE_INSERT_BATCH = int(os.getenv("OFFLINE_INSERT_BATCH", 1000))
+UNKNOWN_NAME = "Visitor - Access Pending"
+
+def _sightings(frame, options, input_index, source, index, timestamp, offset=None):
+    # ``frame`` is BGR as decoded; dlib wants RGB
+    rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    boxes = detect_faces(rgb_frame, options["scale"], options["upsample"])
+    if not boxes:
+        return []
+    encodings = face_recognition.face_encodings(rgb_frame, boxes)
+    matches = worker_gallery().match(
+        encodings, tolerance=options["tolerance"], mode=options["mode"]
+    )
+
+    rows = []
+    for i, (box, match) in enumerate(zip(boxes, matches)):
+        top, right, bottom, left = box
+        crop_path = None
+        if options["crops_dir"]:
+            crop_path = os.path.join(options["crops_dir"], f"{input_index}_{index:08d}_{i}.jpg")
+            cv2.imwrite(crop_path, frame[top:bottom, left:right])
+        rows.append(
+            {
+                "input": input_index,
+                "source": source,
+                "frame": index,
+                "offset": offset,
+                "timestamp": timestamp,
+                "box": [int(top), int(right), int(bottom), int(left)],
+                "name": match.name,
+                "distance": float(match.distance) if np.isfinite(match.distance) else None,
+                "crop": crop_path,
+            }
+        )
+    return rows
+
+
+def _video_chunk(task):
+    _, input_index, path, start, end, step, fps, started, options = task
+    cap = cv2.VideoCapture(path)
+    rows, sampled = [], 0
+    try:
+        if start:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        index = start
+        while end is None or index < end:
+            # Skipped frames are only grabbed, never decoded. Sampling follows
+            # the absolute frame number so chunk edges do not shift it
+            if index % step:
+                if not cap.grab():
+                    break
+            else:
+                ok, frame = cap.read()
+                if not ok:
+                    break
+                offset = index / fps
+                timestamp = started + timedelta(seconds=offset)
+                rows += _sightings(frame, options, input_index, path, index, timestamp, offset)
+                sampled += 1
+            index += 1
+    finally:
+        cap.release()
+    return sampled, rows
+
+
+def _image_chunk(task):
+    _, input_index, images, options = task
+    rows, sampled = [], 0
+    for index, path in images:
+        frame = cv2.imread(path)
+        if frame is None:
+            continue
+        timestamp = datetime.fromtimestamp(os.path.getmtime(path))
+        rows += _sightings(frame, options, input_index, path, index, timestamp)
+        sampled += 1
+    return sampled, rows
+
+
+def process_chunk(task):
+    """Runs in a pool process: recognize one chunk of a video or image folder."""
+    if task[0] == "video":
+        return _video_chunk(task)
+    return _image_chunk(task)
+
+
+def video_tasks(input_index, path, options, sample_fps, chunk_seconds, start_time=None):
+    cap = cv2.VideoCapture(path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+    count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    step = max(1, round(fps / sample_fps)) if sample_fps else 1
+    if start_time is None:
+        # Recorders close the file when the recording ends
+        start_time = datetime.fromtimestamp(os.path.getmtime(path)) - timedelta(
+            seconds=max(count, 0) / fps
+        )
+    if count <= 0:
+        # Length unknown (some streams and containers), read it in one go
+        return [("video", input_index, path, 0, None, step, fps, start_time, options)]
+    chunk = max(step, int(chunk_seconds * fps))
+    tasks = []
+    for start in range(0, count, chunk):
+        end = min(start + chunk, count)
+        tasks.append(("video", input_index, path, start, end, step, fps, start_time, options))
+    return tasks
+
+
+def image_tasks(input_index, directory, options, chunk_size):
+    paths = sorted(
+        os.path.join(root, file)
+        for root, _, files in os.walk(directory)
+        for file in files
+        if is_face_image(file)
+    )
+    images = list(enumerate(paths))
+    return [
+        ("images", input_index, images[i : i + chunk_size], options)
+        for i in range(0, len(images), chunk_size)
+    ]
+
+
+def run(tasks, gallery, workers=OFFLINE_WORKERS):
+    """Recognize every task in a process pool sharing ``gallery``; returns
+    the sightings ordered by input and time."""
+    publisher = SharedGalleryPublisher()
+    publisher.publish(gallery)
+    rows, sampled = [], 0
+    started = time.perf_counter()
+    try:
+        with multiprocessing.Pool(
+            max(1, workers), initializer=init_worker, initargs=(publisher.name,)
+        ) as pool:
+            for done, (chunk_sampled, chunk_rows) in enumerate(
+                pool.imap_unordered(process_chunk, tasks), 1
+            ):
+                sampled += chunk_sampled
+                rows += chunk_rows
+                elapsed = time.perf_counter() - started
+                print(
+                    f"{done}/{len(tasks)} chunks, {sampled} frames "
+                    f"({sampled / elapsed:.1f}/s), {len(rows)} faces"
+                )
+    finally:
+        publisher.close()
+    rows.sort(key=lambda row: (row["input"], row["timestamp"], row["frame"]))
+    return rows
+
+
+def write_jsonl(rows, path):
+    with open(path, "w") as f:
+        for row in rows:
+            row = dict(row, timestamp=row["timestamp"].isoformat(timespec="milliseconds"))
+            f.write(json.dumps(row) + "\n")
+
+
+def write_columns(rows, path):
+    # One array per field, far smaller and faster to load than JSONL for
+    # hours of footage; missing names/crops are "", missing numbers NaN
+    np.savez_compressed(
+        path,
+        inputs=np.array([row["input"] for row in rows], dtype=np.int32),
+        sources=np.array([row["source"] for row in rows], dtype=str),
+        frames=np.array([row["frame"] for row in rows], dtype=np.int64),
+        offsets=np.array(
+            [np.nan if row["offset"] is None else row["offset"] for row in rows], dtype=np.float64
+        ),
+        timestamps=np.array([row["timestamp"] for row in rows], dtype="datetime64[ms]"),
+        boxes=np.array([row["box"] for row in rows], dtype=np.int32).reshape(-1, 4),
+        names=np.array([row["name"] or "" for row in rows], dtype=str),
+        distances=np.array(
+            [np.nan if row["distance"] is None else row["distance"] for row in rows],
+            dtype=np.float32,
+        ),
+        crops=np.array([row["crop"] or "" for row in rows], dtype=str),
+    )
+
+
+def collapse_sightings(rows, gap=VISIT_TIMEOUT):
+    """One sighting per person (unknown faces counting as one) and input,
+    starting a new one once they were not seen for ``gap`` seconds, as the
+    camera node's visits do. Keeps the closest match, or the largest face
+    for unknown people."""
+    groups = {}
+    collapsed = []
+
+    def score(row):
+        if row["name"] is not None:
+            return -(row["distance"] or 0.0)
+        top, right, bottom, left = row["box"]
+        return (bottom - top) * (right - left)
+
+    for row in rows:
+        key = (row["input"], row["name"])
+        group = groups.get(key)
+        if group is None or (row["timestamp"] - group["last_seen"]).total_seconds() > gap:
+            group = groups[key] = {"best": row, "started": row["timestamp"]}
+            collapsed.append(group)
+        elif score(row) > score(group["best"]):
+            group["best"] = row
+        group["last_seen"] = row["timestamp"]
+    return [dict(group["best"], timestamp=group["started"]) for group in collapsed]
+
+
+def insert_history(rows, collection, history_dir="history/", batch_size=OFFLINE_INSERT_BATCH):
+    """Copy the crops into the history folder and insert one document per
+    row, in the shape the camera node's history writer uses."""
+    documents = []
+    for row in rows:
+        record_id = ObjectId()
+        name = row["name"] or UNKNOWN_NAME
+        image_path = history_path(history_dir, name, row["timestamp"], record_id)
+        shutil.copyfile(row["crop"], image_path)
+        documents.append(
+            {
+                "_id": record_id,
+                "name": name,
+                "image_path": image_path,
+                "date": row["timestamp"],
+                "status": row["name"] is not None,
+            }
+        )
+    for i in range(0, len(documents), batch_size):
+        collection.insert_many(documents[i : i + batch_size], ordered=False)
+    return len(documents)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Recognize faces in recorded video files and image folders"
+    )
+    parser.add_argument("--video", action="append", default=[], help="video file to process")
+    parser.add_argument("--images", action="append", default=[], help="image folder to process")
+    parser.add_argument("--faces", default="faces/", help="face database used as gallery")
+    parser.add_argument("--store", default=STORE_PATH, help="encoding store file")
+    parser.add_argument(
+        "--output",
+        default="offline_results.jsonl",
+        help="results file, columnar .npz when it ends in .npz, JSONL otherwise",
+    )
+    parser.add_argument(
+        "--sample-fps",
+        type=float,
+        default=2.0,
+        help="video frames per second to recognize, 0 for every frame",
+    )
+    parser.add_argument(
+        "--start-time",
+        type=datetime.fromisoformat,
+        default=None,
+        help="recording start of the videos (ISO), default their mtime minus their length",
+    )
+    parser.add_argument("--workers", type=int, default=OFFLINE_WORKERS)
+    parser.add_argument("--chunk-seconds", type=float, default=OFFLINE_CHUNK_SECONDS)
+    parser.add_argument("--chunk-images", type=int, default=OFFLINE_CHUNK_IMAGES)
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="detection scale, below 1 is faster but misses small faces",
+    )
+    parser.add_argument("--upsample", type=int, default=1)
+    parser.add_argument("--tolerance", type=float, default=0.7)
+    parser.add_argument("--mode", default="nearest", choices=["nearest", "centroid"])
+    parser.add_argument("--crops", default=None, help="folder to save every face crop in")
+    parser.add_argument(
+        "--history",
+        action="store_true",
+        help="also insert one history record per visit into MongoDB (MONGO_URI)",
+    )
+    args = parser.parse_args()
+    if not args.video and not args.images:
+        parser.error("nothing to process, pass --video and/or --images")
+
+    # History records need crops; keep them in a temporary folder unless asked for
+    crops_dir = args.crops or (tempfile.mkdtemp(prefix="offline_crops_") if args.history else None)
+    if crops_dir:
+        os.makedirs(crops_dir, exist_ok=True)
+    options = {
+        "scale": args.scale,
+        "upsample": args.upsample,
+        "tolerance": args.tolerance,
+        "mode": args.mode,
+        "crops_dir": crops_dir,
+    }
+
+    tasks = []
+    for input_index, path in enumerate(args.video):
+        tasks += video_tasks(
+            input_index, path, options, args.sample_fps, args.chunk_seconds, args.start_time
+        )
+    for input_index, directory in enumerate(args.images, len(args.video)):
+        tasks += image_tasks(input_index, directory, options, args.chunk_images)
+
+    gallery = Gallery.from_store(load_store(args.faces, args.store))
+    print(f"Processing {len(tasks)} chunks against {len(gallery)} encodings")
+    rows = run(tasks, gallery, args.workers)
+
+    if args.output.endswith(".npz"):
+        write_columns(rows, args.output)
+    else:
+        write_jsonl(rows, args.output)
+    print(f"{len(rows)} faces written to {args.output}")
+
+    if args.history:
+        client = MongoClient(os.getenv("MONGO_URI"))
+        try:
+            inserted = insert_history(collapse_sightings(rows), client["CameraDb"]["history"])
+        finally:
+            client.close()
+            if not args.crops:
+                shutil.rmtree(crops_dir, ignore_errors=True)
+        print(f"{inserted} history records inserted")
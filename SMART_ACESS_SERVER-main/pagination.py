@@ -0,0 +1,98 @@
+import base64
+import json
+from datetime import datetime
+
+from bson import ObjectId
+from fastapi import HTTPException
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+STREAM_BATCH_SIZE = 500
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def format_date(value):
+    return value.strftime(DATE_FORMAT) if isinstance(value, datetime) else value
+
+
+def _cursor_value(value):
+    if isinstance(value, datetime):
+        return {"type": "date", "value": value.isoformat()}
+    if isinstance(value, str):
+        return {"type": "string", "value": value}
+    # Missing and null, e.g. documents added through /history/
+    return {"type": "null"}
+
+
+def encode_cursor(document, field=None):
+    """Opaque cursor pointing just after ``document`` in a
+    (field desc, _id desc) ordering; ``field=None`` orders by _id only."""
+    position = {"id": str(document["_id"])}
+    if field is not None:
+        position["value"] = _cursor_value(document.get(field))
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor, field=None):
+    """Mongo filter selecting the documents after ``cursor``."""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        last_id = ObjectId(position["id"])
+        if field is None:
+            return {"_id": {"$lt": last_id}}
+        value = position["value"]
+        if isinstance(value, str):
+            # cursors handed out before non-date values were supported
+            value = {"type": "date", "value": value}
+        # Sorted descending, MongoDB puts dates first, then strings, then
+        # null/missing values; $lt only compares values of the same type
+        if value["type"] == "date":
+            value, below = datetime.fromisoformat(value["value"]), ["date"]
+        elif value["type"] == "string":
+            value, below = str(value["value"]), ["date", "string"]
+        elif value["type"] == "null":
+            return {field: {"$not": {"$type": ["date", "string"]}}, "_id": {"$lt": last_id}}
+        else:
+            raise ValueError(value["type"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return {
+        "$or": [
+            {field: {"$lt": value}},
+            {field: value, "_id": {"$lt": last_id}},
+            {field: {"$not": {"$type": below}}},
+        ]
+    }
+
+
+def page_size(limit):
+    return max(1, min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+
+
+async def fetch_page(collection, query, projection, limit, cursor=None, field=None):
+    """Keyset page sorted newest first; returns (documents, next_cursor)."""
+    if cursor:
+        query = {"$and": [query, decode_cursor(cursor, field)]}
+    sort = [("_id", -1)] if field is None else [(field, -1), ("_id", -1)]
+    # One extra document tells whether another page exists
+    documents = (
+        await collection.find(query, projection).sort(sort).limit(limit + 1).to_list(length=None)
+    )
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = encode_cursor(documents[-1], field)
+    return documents, next_cursor
+
+
+async def stream_json_array(collection, query, projection, transform, field=None, prefix="", suffix=""):
+    """Yield a JSON array of every matching document without materializing
+    the result set; ``prefix``/``suffix`` wrap the array in an object."""
+    sort = [("_id", -1)] if field is None else [(field, -1), ("_id", -1)]
+    cursor = collection.find(query, projection).sort(sort).batch_size(STREAM_BATCH_SIZE)
+    yield prefix + "["
+    first = True
+    async for document in cursor:
+        yield ("" if first else ",") + json.dumps(transform(document))
+        first = False
+    yield "]" + suffix
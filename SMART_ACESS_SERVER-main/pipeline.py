@@ -0,0 +1,132 @@
+import queue
+import threading
+import time
+from collections import deque
+
+import cv2
+
+
+class DropOldestQueue:
+    """Bounded FIFO queue that discards the oldest item instead of blocking
+    the producer when it is full."""
+
+    def __init__(self, maxsize):
+        self.items = deque(maxlen=maxsize)
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item):
+        with self.condition:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.items or self.closed, timeout):
+                raise queue.Empty
+            if not self.items:
+                raise queue.Empty
+            return self.items.popleft()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class LatestFrameGrabber:
+    """Reads a capture source on its own thread and keeps only the newest
+    frame, so slow consumers skip frames instead of falling behind."""
+
+    def __init__(self, source=0):
+        self.source = source
+        self.cap = cv2.VideoCapture(source)
+        self.condition = threading.Condition()
+        self.frame = None
+        self.frame_id = 0
+        self.running = False
+        self.failed = False
+        self.thread = threading.Thread(target=self._run, name="capture", daemon=True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while self.running:
+            ret, frame = self.cap.read()
+            with self.condition:
+                if not ret:
+                    print("Failed to grab frame")
+                    self.failed = True
+                    self.running = False
+                else:
+                    self.frame = frame
+                    self.frame_id += 1
+                self.condition.notify_all()
+
+    def read(self, after_id=0, timeout=1.0):
+        """Wait for a frame newer than ``after_id``; returns (frame_id, frame)
+        or (after_id, None) if none arrived in time or capture stopped."""
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.frame_id > after_id or not self.running, timeout
+            )
+            if self.frame_id > after_id:
+                return self.frame_id, self.frame
+            return after_id, None
+
+    def stop(self):
+        self.running = False
+        if self.thread.is_alive():
+            self.thread.join(timeout=2.0)
+        self.cap.release()
+
+
+class WorkerPool:
+    """Threads consuming a DropOldestQueue with ``handler``."""
+
+    def __init__(self, handler, workers=1, queue_size=2, name="worker"):
+        self.handler = handler
+        self.queue = DropOldestQueue(queue_size)
+        self.running = True
+        self.threads = [
+            threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def submit(self, item):
+        self.queue.put(item)
+
+    def _run(self):
+        while self.running:
+            try:
+                item = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self.handler(item)
+            except Exception as e:
+                print(f"Error in {threading.current_thread().name}:", e)
+
+    def stop(self, drain=False):
+        # With drain=True queued items are still handled before returning
+        if drain:
+            while len(self.queue) and any(t.is_alive() for t in self.threads):
+                time.sleep(0.05)
+        self.running = False
+        self.queue.close()
+        for thread in self.threads:
+            thread.join(timeout=5.0)
@@ -0,0 +1,233 @@
+import asyncio
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import face_recognition
+import numpy as np
+
+from encoding_store import encode_image
+from gallery_sync import GalleryReplica, unpack_vector
+from metrics import Counter, Gauge, Histogram
+
+RECOGNIZE_WORKERS = int(os.getenv("RECOGNIZE_WORKERS", os.cpu_count() or 1))
+# Images arriving within RECOGNIZE_BATCH_WAIT_MS are sent to the pool together
+RECOGNIZE_BATCH_SIZE = int(os.getenv("RECOGNIZE_BATCH_SIZE", 16))
+RECOGNIZE_BATCH_WAIT_MS = float(os.getenv("RECOGNIZE_BATCH_WAIT_MS", 10))
+RECOGNIZE_TOLERANCE = float(os.getenv("RECOGNIZE_TOLERANCE", 0.6))
+# Seconds start() waits for every worker to load the models
+POOL_WARM_TIMEOUT = float(os.getenv("POOL_WARM_TIMEOUT", 300))
+
+STAGE_SECONDS = Histogram("recognize_stage_seconds", "Recognition stage latency", ["stage"])
+RECOGNITIONS = Counter("recognize_faces_total", "Faces matched against the gallery", ["result"])
+GALLERY_RELOADS = Counter("recognize_gallery_reloads_total", "Gallery loads and rebuilds")
+QUEUE_DEPTH = Gauge("recognize_queue_depth", "Images waiting for a recognition batch")
+
+
+_warm_barrier = None
+
+
+def warm_worker(barrier=None):
+    # Load the dlib detector and encoder once per process, not per request
+    global _warm_barrier
+    _warm_barrier = barrier
+    blank = np.zeros((64, 64, 3), dtype=np.uint8)
+    face_recognition.face_encodings(blank, [(0, 63, 63, 0)])
+    face_recognition.face_locations(blank)
+
+
+def worker_ready():
+    # Held until every worker has taken one call, so each warms exactly once
+    if _warm_barrier is not None:
+        _warm_barrier.wait(timeout=POOL_WARM_TIMEOUT)
+    return os.getpid()
+
+
+def encode_images(images):
+    """Runs in a pool process: detect and encode every face of every image."""
+    results = []
+    for data in images:
+        try:
+            image = face_recognition.load_image_file(io.BytesIO(data))
+        except Exception as e:
+            results.append({"error": f"Invalid image: {e}"})
+            continue
+        boxes = face_recognition.face_locations(image)
+        encodings = face_recognition.face_encodings(image, boxes)
+        results.append(
+            {"boxes": boxes, "encodings": [np.asarray(e, dtype=np.float32) for e in encodings]}
+        )
+    return results
+
+
+class RecognitionService:
+    """Warm process pool for detection/encoding plus the server's in-memory
+    gallery, built from the vectors stored in the pictures collection."""
+
+    def __init__(
+        self,
+        workers=RECOGNIZE_WORKERS,
+        batch_size=RECOGNIZE_BATCH_SIZE,
+        batch_wait_ms=RECOGNIZE_BATCH_WAIT_MS,
+    ):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait_ms / 1000.0
+        self.replica = GalleryReplica()
+        self.gallery = None
+        self.pool = None
+        self.queue = None
+        self.batcher = None
+        # Batches in flight; the loop only keeps weak references to tasks
+        self.batches = set()
+        self.gallery_lock = asyncio.Lock()
+
+    async def start(self):
+        context = multiprocessing.get_context("spawn")
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=context,
+            initializer=warm_worker,
+            initargs=(context.Barrier(self.workers),),
+        )
+        # Workers are only spawned (and warmed) on demand; one call per worker
+        # spawns them all now, so no request pays for loading the models
+        loop = asyncio.get_running_loop()
+        try:
+            ready = await asyncio.gather(
+                *(loop.run_in_executor(self.pool, worker_ready) for _ in range(self.workers))
+            )
+            print(f"Recognition pool warmed with {len(set(ready))} workers")
+        except Exception as e:
+            print(f"Could not warm every recognition worker: {e!r}")
+        self.queue = asyncio.Queue()
+        QUEUE_DEPTH.set_function(self.queue.qsize)
+        self.batcher = asyncio.create_task(self._batch_forever())
+
+    async def stop(self):
+        if self.batcher is not None:
+            self.batcher.cancel()
+        for task in self.batches:
+            task.cancel()
+        await asyncio.gather(*self.batches, return_exceptions=True)
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    async def load_gallery(self, pictures):
+        async with self.gallery_lock:
+            async for picture in pictures.find(
+                {"encoding": {"$ne": None}}, {"name": 1, "encoding": 1}
+            ):
+                self.replica.put(
+                    str(picture["_id"]), picture["name"], unpack_vector(picture["encoding"])
+                )
+            self.gallery = await asyncio.to_thread(self.replica.gallery)
+        GALLERY_RELOADS.inc()
+        print(f"Recognition gallery loaded with {len(self.gallery)} encodings")
+
+    async def add(self, picture_id, name, vector):
+        await self.add_many([(picture_id, name, vector)])
+
+    async def add_many(self, pictures):
+        async with self.gallery_lock:
+            for picture_id, name, vector in pictures:
+                self.replica.put(picture_id, name, vector)
+            await self._rebuild([picture_id for picture_id, _, _ in pictures])
+
+    async def remove(self, picture_id):
+        async with self.gallery_lock:
+            if self.replica.remove(picture_id):
+                await self._rebuild([picture_id])
+
+    async def _rebuild(self, picture_ids):
+        # Building a large gallery (and its index) would stall the event loop
+        if self.gallery is not None:
+            self.gallery = await asyncio.to_thread(
+                self.replica.gallery, self.gallery, picture_ids
+            )
+            GALLERY_RELOADS.inc()
+
+    async def encode_file(self, image_path):
+        """Encoding of the first face in an enrolled image, None without one."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, encode_image, image_path)
+
+    async def encode(self, data):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((data, future))
+        return await future
+
+    async def _batch_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.create_task(self._run_batch(batch))
+            self.batches.add(task)
+            task.add_done_callback(self._batch_done)
+
+    def _batch_done(self, task):
+        self.batches.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Recognition batch failed: {task.exception()!r}")
+
+    async def _run_batch(self, batch):
+        try:
+            await self._encode_batch(batch)
+        finally:
+            # Nobody waits forever on a batch that was cancelled or failed
+            for _, future in batch:
+                if not future.done():
+                    future.cancel()
+
+    async def _encode_batch(self, batch):
+        # Spread the batch over the workers, one pool call per chunk
+        loop = asyncio.get_running_loop()
+        chunk_size = max(1, -(-len(batch) // self.workers))
+        chunks = [batch[i : i + chunk_size] for i in range(0, len(batch), chunk_size)]
+        calls = [
+            loop.run_in_executor(self.pool, encode_images, [data for data, _ in chunk])
+            for chunk in chunks
+        ]
+        for chunk, call in zip(chunks, calls):
+            try:
+                with STAGE_SECONDS.time(stage="encode"):
+                    results = await call
+            except Exception as e:
+                for _, future in chunk:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(chunk, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def recognize(self, data, tolerance=RECOGNIZE_TOLERANCE):
+        encoded = await self.encode(data)
+        if "error" in encoded:
+            return encoded
+        with STAGE_SECONDS.time(stage="match"):
+            matches = self.gallery.match(encoded["encodings"], tolerance=tolerance)
+        for match in matches:
+            RECOGNITIONS.inc(result="recognized" if match.name is not None else "unknown")
+        return {
+            "faces": [
+                {
+                    "box": {"top": top, "right": right, "bottom": bottom, "left": left},
+                    "name": match.name,
+                    # inf (empty gallery, single identity) is not valid JSON
+                    "distance": float(match.distance) if np.isfinite(match.distance) else None,
+                    "margin": float(match.margin) if np.isfinite(match.margin) else None,
+                }
+                for (top, right, bottom, left), match in zip(encoded["boxes"], matches)
+            ]
+        }
@@ -0,0 +1,233 @@
+import asyncio
+import os
+import shutil
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from pymongo import ASCENDING
+
+from database import history_collection
+
+HISTORY_DIR = "history"
+# 0 disables the corresponding limit
+HISTORY_RETENTION_DAYS = float(os.getenv("HISTORY_RETENTION_DAYS", 0))
+HISTORY_MAX_BYTES = int(os.getenv("HISTORY_MAX_BYTES", 0))
+# How often (seconds) the retention policy is enforced
+HISTORY_RETENTION_INTERVAL = float(os.getenv("HISTORY_RETENTION_INTERVAL", 3600))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", 500))
+# Images no document points to are removed once this old (seconds); younger
+# ones may belong to records still queued or spooled by a history writer
+HISTORY_ORPHAN_AGE = float(os.getenv("HISTORY_ORPHAN_AGE", 86400))
+
+
+def _remove_files(paths, max_bytes=None):
+    """Remove files in order until ``max_bytes`` are freed; returns how many
+    paths were handled (missing files included) and the bytes freed."""
+    removed_bytes = 0
+    for count, path in enumerate(paths, 1):
+        try:
+            removed_bytes += os.path.getsize(path)
+            os.remove(path)
+        except (FileNotFoundError, TypeError):
+            pass
+        if max_bytes is not None and removed_bytes >= max_bytes:
+            return count, removed_bytes
+    return len(paths), removed_bytes
+
+
+def _day_directories(history_dir):
+    # history/YYYY/MM/DD, oldest first
+    days = []
+    for year in sorted(os.listdir(history_dir)):
+        year_dir = os.path.join(history_dir, year)
+        if not (year.isdigit() and os.path.isdir(year_dir)):
+            continue
+        for month in sorted(os.listdir(year_dir)):
+            month_dir = os.path.join(year_dir, month)
+            if not os.path.isdir(month_dir):
+                continue
+            for day in sorted(os.listdir(month_dir)):
+                day_dir = os.path.join(month_dir, day)
+                try:
+                    days.append((datetime(int(year), int(month), int(day)), day_dir))
+                except ValueError:
+                    continue
+    return days
+
+
+def _remove_empty_directories(history_dir):
+    for root, _, _ in os.walk(history_dir, topdown=False):
+        if root != history_dir and not os.listdir(root):
+            os.rmdir(root)
+
+
+def _remove_days_before(history_dir, cutoff):
+    """Drop whole day partitions older than ``cutoff``, including files no
+    document points to any more, then any emptied month/year folders."""
+    for day, day_dir in _day_directories(history_dir):
+        if day + timedelta(days=1) <= cutoff:
+            shutil.rmtree(day_dir, ignore_errors=True)
+    _remove_empty_directories(history_dir)
+
+
+def _remove_files_before(history_dir, cutoff):
+    # Everything written before ``cutoff``, partitioned or from the old flat layout
+    timestamp = cutoff.timestamp()
+    removed = 0
+    for root, _, files in os.walk(history_dir):
+        for file in files:
+            path = os.path.join(root, file)
+            if os.path.getmtime(path) < timestamp:
+                os.remove(path)
+                removed += 1
+    _remove_empty_directories(history_dir)
+    return removed
+
+
+def _remove_orphans(history_dir, referenced, cutoff):
+    """Remove files under ``history_dir`` older than ``cutoff`` (a timestamp)
+    that are not in ``referenced``; returns (files, bytes) removed."""
+    removed = removed_bytes = 0
+    for root, _, files in os.walk(history_dir):
+        for file in files:
+            path = os.path.abspath(os.path.join(root, file))
+            if path in referenced or os.path.getmtime(path) >= cutoff:
+                continue
+            removed_bytes += os.path.getsize(path)
+            os.remove(path)
+            removed += 1
+    _remove_empty_directories(history_dir)
+    return removed, removed_bytes
+
+
+def _files_size(paths):
+    total = 0
+    for path in paths:
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+
+def history_size(history_dir):
+    total = 0
+    for root, _, files in os.walk(history_dir):
+        for file in files:
+            total += os.path.getsize(os.path.join(root, file))
+    return total
+
+
+async def purge_history(query, job=None, max_bytes=None, batch_size=RETENTION_BATCH_SIZE):
+    """Delete history documents matching ``query`` oldest first, together
+    with their images, one batch at a time. Stops once ``max_bytes`` image
+    bytes have been freed when given, or when a batch frees none. Returns
+    (documents, bytes) removed."""
+    deleted = freed = 0
+    while max_bytes is None or freed < max_bytes:
+        batch = [
+            record
+            async for record in history_collection.find(query, {"image_path": 1})
+            .sort("date", ASCENDING)
+            .limit(batch_size)
+        ]
+        if not batch:
+            break
+        handled, removed_bytes = await asyncio.to_thread(
+            _remove_files,
+            [record.get("image_path") for record in batch],
+            None if max_bytes is None else max_bytes - freed,
+        )
+        if max_bytes is not None and not removed_bytes:
+            # Their images are gone already, deleting them frees nothing
+            break
+        freed += removed_bytes
+        result = await history_collection.delete_many(
+            {"_id": {"$in": [record["_id"] for record in batch[:handled]]}}
+        )
+        deleted += result.deleted_count
+        if job is not None:
+            job.processed = deleted
+            job.counts = {"documents": deleted, "bytes": freed}
+    return deleted, freed
+
+
+async def clear_history(job, history_dir=HISTORY_DIR):
+    # Only what existed when the purge started, visits recorded meanwhile stay.
+    # Bounded by creation time: not every document has a datetime "date".
+    # Whole seconds, the resolution of an ObjectId's timestamp
+    started = datetime.now(timezone.utc).replace(microsecond=0)
+    query = {"_id": {"$lt": ObjectId.from_datetime(started)}}
+    job.total = await history_collection.count_documents(query)
+    await purge_history(query, job)
+    if os.path.exists(history_dir):
+        job.counts["orphaned_files"] = await asyncio.to_thread(
+            _remove_files_before, history_dir, started
+        )
+
+
+class HistoryRetention:
+    """Background task enforcing the age and size limits on history."""
+
+    def __init__(
+        self,
+        history_dir=HISTORY_DIR,
+        retention_days=HISTORY_RETENTION_DAYS,
+        max_bytes=HISTORY_MAX_BYTES,
+        interval=HISTORY_RETENTION_INTERVAL,
+    ):
+        self.history_dir = history_dir
+        self.retention_days = retention_days
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.task = None
+
+    def start(self):
+        if self.retention_days or self.max_bytes:
+            self.task = asyncio.create_task(self._run())
+        return self
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.enforce()
+            except Exception as e:
+                print(f"Error enforcing history retention: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def enforce(self):
+        if not os.path.exists(self.history_dir):
+            return
+        if self.retention_days:
+            cutoff = datetime.now() - timedelta(days=self.retention_days)
+            deleted, freed = await purge_history({"date": {"$lt": cutoff}})
+            await asyncio.to_thread(_remove_days_before, self.history_dir, cutoff)
+            if deleted:
+                print(f"Retention removed {deleted} history records ({freed} bytes) before {cutoff}")
+
+        if self.max_bytes:
+            await self._enforce_size()
+
+    async def _enforce_size(self):
+        query = {"image_path": {"$type": "string"}}
+        referenced = {
+            os.path.abspath(record["image_path"])
+            async for record in history_collection.find(query, {"image_path": 1})
+        }
+        # Files no document points to first, deleting documents never frees them
+        orphans, orphan_bytes = await asyncio.to_thread(
+            _remove_orphans, self.history_dir, referenced, time.time() - HISTORY_ORPHAN_AGE
+        )
+        if orphans:
+            print(f"Retention removed {orphans} orphaned history images ({orphan_bytes} bytes)")
+        excess = await asyncio.to_thread(history_size, self.history_dir) - self.max_bytes
+        # Young orphans may still be over the limit; documents only free their own images
+        excess = min(excess, await asyncio.to_thread(_files_size, referenced))
+        if excess > 0:
+            deleted, freed = await purge_history(query, max_bytes=excess)
+            print(f"Retention removed {deleted} history records to free {freed} bytes")
@@ -0,0 +1,120 @@
+import json
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from encoding_store import ENCODING_SIZE
+from gallery import Gallery
+
+# control block: uint64 version followed by the data block name
+CONTROL_SIZE = 128
+NAME_OFFSET = 8
+# data block: int64 count and names length, then matrix, labels and names
+HEADER_SIZE = 16
+
+
+def _data_layout(count):
+    matrix_bytes = count * ENCODING_SIZE * 4
+    labels_offset = HEADER_SIZE + matrix_bytes
+    names_offset = labels_offset + count * 4
+    return labels_offset, names_offset
+
+
+class SharedGalleryPublisher:
+    """Publishes galleries into shared memory for worker processes.
+
+    Every publish writes a complete new data block and then flips the
+    control block to it, so readers never see a half-written matrix. The
+    previous block is unlinked right away; readers that still map it keep
+    a valid view until they move on to the new version.
+    """
+
+    def __init__(self, name=None):
+        self.name = name or f"smartaccess_gallery_{os.getpid()}"
+        self.control = shared_memory.SharedMemory(name=self.name, create=True, size=CONTROL_SIZE)
+        self.control.buf[:CONTROL_SIZE] = bytes(CONTROL_SIZE)
+        self.block = None
+        self.version = 0
+
+    def publish(self, gallery):
+        count = len(gallery)
+        names = json.dumps(gallery.label_names).encode()
+        labels_offset, names_offset = _data_layout(count)
+        size = names_offset + len(names)
+
+        self.version += 1
+        block = shared_memory.SharedMemory(
+            name=f"{self.name}_{self.version}", create=True, size=max(size, 1)
+        )
+        header = np.ndarray((2,), dtype=np.int64, buffer=block.buf)
+        header[:] = (count, len(names))
+        matrix = np.ndarray((count, ENCODING_SIZE), dtype=np.float32, buffer=block.buf, offset=HEADER_SIZE)
+        matrix[:] = gallery.matrix
+        labels = np.ndarray((count,), dtype=np.int32, buffer=block.buf, offset=labels_offset)
+        labels[:] = gallery.labels
+        block.buf[names_offset:size] = names
+        del header, matrix, labels
+
+        # Name first, version last: readers retry while the two disagree
+        encoded_name = block.name.encode().ljust(CONTROL_SIZE - NAME_OFFSET, b"\0")
+        self.control.buf[NAME_OFFSET:CONTROL_SIZE] = encoded_name
+        np.ndarray((1,), dtype=np.uint64, buffer=self.control.buf)[0] = self.version
+
+        previous, self.block = self.block, block
+        if previous is not None:
+            previous.close()
+            previous.unlink()
+
+    def close(self):
+        for block in (self.block, self.control):
+            if block is not None:
+                block.close()
+                block.unlink()
+        self.block = None
+
+
+class SharedGalleryReader:
+    """Worker-side view of the published gallery; ``current()`` re-attaches
+    only when the publisher has flipped to a new version."""
+
+    def __init__(self, name):
+        self.control = shared_memory.SharedMemory(name=name)
+        self.block = None
+        self.version = 0
+        self.gallery = Gallery([], [])
+
+    def _read_control(self):
+        version = np.ndarray((1,), dtype=np.uint64, buffer=self.control.buf)
+        while True:
+            before = int(version[0])
+            name = bytes(self.control.buf[NAME_OFFSET:CONTROL_SIZE]).rstrip(b"\0").decode()
+            if int(version[0]) == before:
+                return before, name
+
+    def current(self):
+        version, name = self._read_control()
+        if version == self.version or not name:
+            return self.gallery
+
+        try:
+            block = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            # Already replaced by an even newer version, use it next time
+            return self.gallery
+        count, names_len = np.ndarray((2,), dtype=np.int64, buffer=block.buf)
+        labels_offset, names_offset = _data_layout(int(count))
+        matrix = np.ndarray((count, ENCODING_SIZE), dtype=np.float32, buffer=block.buf, offset=HEADER_SIZE)
+        labels = np.ndarray((count,), dtype=np.int32, buffer=block.buf, offset=labels_offset)
+        label_names = json.loads(bytes(block.buf[names_offset : names_offset + names_len]))
+
+        self.gallery = Gallery.from_arrays(matrix, labels, label_names)
+        previous, self.block = self.block, block
+        self.version = version
+        if previous is not None:
+            try:
+                previous.close()
+            except BufferError:
+                # an old Gallery still references the block, let GC release it
+                pass
+        return self.gallery
@@ -1,189 +1,512 @@
+import argparse
 import cv2
 import numpy as np
 import face_recognition
 import os
 import requests
-from datetime import datetime
 from pymongo import MongoClient
-from PIL import Image
 import time
-import hashlib
+import threading
 from dotenv import load_dotenv
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+# Load .env before the local modules below read their settings
 load_dotenv()
 
+from ann_index import index_for  # noqa: E402
+from budget import FrameBudget, QualityGate, select_faces  # noqa: E402
+from encoding_store import EncodingStore, is_face_image, print_sync_stats  # noqa: E402
+from gallery import Gallery  # noqa: E402
+from gallery_sync import GallerySyncClient  # noqa: E402
+from history_writer import HistoryWriter  # noqa: E402
+from live_stream import LIVE_STREAM_PORT, LiveStream  # noqa: E402
+from metrics import (  # noqa: E402
+    METRICS_ENABLED,
+    Counter,
+    Gauge,
+    Histogram,
+    MetricsServer,
+    mongo_event_listeners,
+)
+from motion import MOTION_GATE, MotionGate  # noqa: E402
+from multistream import MultiStreamRunner, parse_source  # noqa: E402
+from pipeline import LatestFrameGrabber, WorkerPool  # noqa: E402
+from shared_gallery import SharedGalleryPublisher  # noqa: E402
+from tracking import FaceTracker, detect_faces  # noqa: E402
+from visits import VisitTracker  # noqa: E402
+
 MONGO_URI = os.getenv("MONGO_URI")
-client = MongoClient(MONGO_URI)
+# Fail fast when MongoDB is unreachable, the history writer spools instead
+client = MongoClient(
+    MONGO_URI,
+    serverSelectionTimeoutMS=int(os.getenv("MONGO_TIMEOUT_MS", 5000)),
+    socketTimeoutMS=int(os.getenv("MONGO_TIMEOUT_MS", 5000)),
+    event_listeners=mongo_event_listeners(),
+)
 db = client["CameraDb"]
 collection = db["history"]
 
+FCM_TOKEN = os.getenv("FCM_TOKEN")
+API_URL = os.getenv("API_URL")
+
+UNKNOWN_NAME = "Visitor - Access Pending"
+# "nearest" matches against every enrolled image, "centroid" against one
+# mean encoding per person
+MATCH_MODE = os.getenv("MATCH_MODE", "nearest")
+# "faces" encodes the local faces/ folder, "server" syncs enrolled vectors
+# from API_URL so the node needs neither the images nor enrollment work
+GALLERY_SOURCE = os.getenv("GALLERY_SOURCE", "faces")
+
+RECOGNITION_WORKERS = int(os.getenv("RECOGNITION_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+SIDE_EFFECT_QUEUE_SIZE = int(os.getenv("SIDE_EFFECT_QUEUE_SIZE", 32))
+# No imshow windows, for servers without a display; stop with Ctrl+C
+HEADLESS = os.getenv("HEADLESS", "0") == "1"
+
 # Define history directory
 history_dir = "history/"
 os.makedirs(history_dir, exist_ok=True)
 os.makedirs("faces", exist_ok=True)
 
+history_writer = HistoryWriter(collection, history_dir)
+
+STAGE_SECONDS = Histogram("camera_stage_seconds", "Camera pipeline stage latency", ["stage"])
+RECOGNITIONS = Counter("camera_recognitions_total", "Faces matched against the gallery", ["result"])
+NOTIFICATIONS = Counter("camera_notifications_total", "Visit notifications sent", ["outcome"])
+NOTIFICATION_SECONDS = Histogram("camera_notification_seconds", "Notification API round trips")
+GALLERY_RELOADS = Counter("camera_gallery_reloads_total", "Gallery swaps", ["source"])
+QUEUE_DEPTH = Gauge("camera_queue_depth", "Items waiting in a pipeline queue", ["queue"])
+QUEUE_DROPPED = Gauge("camera_queue_dropped", "Items a full queue has discarded", ["queue"])
+FRAMES = Counter("camera_frames_total", "Captured frames by what was done with them", ["outcome"])
+HELD_FACES = Counter("camera_faces_held_total", "Faces left for a later frame", ["reason"])
+DETECTION_LEVEL = Gauge("camera_detection_level", "Detection level, 0 is the most expensive")
+
 
 class FaceDirectoryHandler(FileSystemEventHandler):
-    def __init__(self, callback):
+    # One upload fires several events (create + modify), so events are
+    # collected for a short window and handed to the callback as one batch
+    def __init__(self, callback, debounce_seconds=1.0):
         self.callback = callback
+        self.debounce_seconds = debounce_seconds
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def _queue(self, event, path):
+        if not event.is_directory and not is_face_image(path):
+            return
+        with self.lock:
+            self.pending.add(path)
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.debounce_seconds, self._flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _flush(self):
+        with self.lock:
+            paths = self.pending
+            self.pending = set()
+            self.timer = None
+        if paths:
+            self.callback(paths)
 
     def on_created(self, event):
-        if not event.is_directory and event.src_path.endswith(('.jpg', '.png')):
-            self.callback()
+        self._queue(event, event.src_path)
 
     def on_deleted(self, event):
-        if not event.is_directory and event.src_path.endswith(('.jpg', '.png')):
-            self.callback()
+        self._queue(event, event.src_path)
 
     def on_modified(self, event):
-        if not event.is_directory and event.src_path.endswith(('.jpg', '.png')):
-            self.callback()
+        if not event.is_directory:
+            self._queue(event, event.src_path)
 
+    def on_moved(self, event):
+        self._queue(event, event.src_path)
+        self._queue(event, event.dest_path)
 
-def save_image_to_history(image, name, status):
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    filename = f"{name}_{timestamp}.jpg"
-    file_path = os.path.join(history_dir, filename)
+    def stop(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
 
-    image.save(file_path)
 
-    picture_data = {
-        "name": name,
-        "image_path": file_path,
-        "date": datetime.now(),
-        "status": status,
-    }
-    collection.insert_one(picture_data)
-    print(f"Image saved to {file_path} and added to MongoDB")
-
-
-def load_face_encodings(database_path):
-    encodings = []
-    names = []
+def load_face_encodings(database_path, store=None):
     print("Loading face database...")
+    store = store or EncodingStore().load()
+    print_sync_stats(store.sync(database_path))
+    gallery = Gallery.from_store(store)
+    gallery.index = index_for(gallery)
+    print(
+        f"Loaded {len(gallery)} encodings of {len(gallery.label_names)} people from the database."
+    )
+    return gallery
 
-    for person_name in os.listdir(database_path):
-        person_folder = os.path.join(database_path, person_name)
-        if os.path.isdir(person_folder):
-            for file in os.listdir(person_folder):
-                if file.endswith(".jpg") or file.endswith(".png"):
-                    image_path = os.path.join(person_folder, file)
-                    print(f"Loading image: {image_path}")
-                    image = face_recognition.load_image_file(image_path)
-                    face_encs = face_recognition.face_encodings(image)
 
-                    if face_encs:
-                        encodings.append(face_encs[0])
-                        names.append(person_name)
-                    else:
-                        print(f"No faces found in {image_path}")
+def send_notification(title, body):
+    try:
+        with NOTIFICATION_SECONDS.time():
+            response = requests.post(
+                f"{API_URL}/send_notification/",
+                json={
+                    "fcm_token": FCM_TOKEN,
+                    "title": title,
+                    "body": body,
+                },
+                timeout=10,
+            )
+        NOTIFICATIONS.inc(outcome="sent" if response.ok else "rejected")
+        print("Notification response:", response.text)
+    except Exception as e:
+        NOTIFICATIONS.inc(outcome="error")
+        print("Error sending notification:", e)
+
+
+def notify_visit(visit):
+    if visit.recognized:
+        send_notification("Registered Person Detected", f"{visit.name} was recognized")
+    else:
+        send_notification("Unknown Person Detected", "Unregistered person detected")
+
+
+def record_visit(visit):
+    # One history entry per visit, with the sharpest crop seen during it
+    if visit.best_crop is None:
+        return
+    name = visit.name or UNKNOWN_NAME
+    history_writer.submit(visit.best_crop, name, visit.recognized, visit.started)
+
+
+def watch_queue(name, work_queue):
+    QUEUE_DEPTH.set_function(lambda: len(work_queue), queue=name)
+    QUEUE_DROPPED.set_function(lambda: work_queue.dropped, queue=name)
+
+
+def run_side_effect(item):
+    # Runs on the side-effect thread, never on the capture/recognition path
+    handler, visit = item
+    handler(visit)
+
+
+def identify(rgb_frame, face_locations):
+    with STAGE_SECONDS.time(stage="encode"):
+        face_encodings = face_recognition.face_encodings(rgb_frame, face_locations)
+    with STAGE_SECONDS.time(stage="match"):
+        matches = gallery.match(face_encodings, tolerance=0.7, mode=MATCH_MODE)
+    for match in matches:
+        RECOGNITIONS.inc(result="recognized" if match.name is not None else "unknown")
+    return face_encodings, matches
+
+
+def draw_faces(frame, faces):
+    for (top, right, bottom, left), match in faces:
+        name = match.name or UNKNOWN_NAME
+        cv2.rectangle(frame, (left, top), (right, bottom), (0, 255, 0), 2)
+        cv2.putText(
+            frame, name, (left, top - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2
+        )
+
+
+def make_visit_tracker(side_effects):
+    return VisitTracker(
+        on_open=lambda visit: side_effects.submit((notify_visit, visit)),
+        on_close=lambda visit: side_effects.submit((record_visit, visit)),
+    )
+
+
+def run_camera(source, side_effects, live_stream=None):
+    # capture thread -> recognition workers -> side-effect thread; every
+    # queue is bounded and drops its oldest entry when a stage falls behind
+    latest = {"frame_id": 0, "faces": []}
+    latest_lock = threading.Lock()
+    tracker = FaceTracker()
+    visits = make_visit_tracker(side_effects)
+    motion_gate = MotionGate() if MOTION_GATE else None
+    budget = FrameBudget()
+    quality_gate = QualityGate()
+    DETECTION_LEVEL.set_function(lambda: budget.level)
+
+    def recognition_worker(item):
+        with STAGE_SECONDS.time(stage="recognition"):
+            recognize(item)
+
+    def recognize(item):
+        frame_id, frame = item
+        started = time.perf_counter()
+        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+        # Detection and encoding run outside the lock so workers overlap;
+        # only the cheap tracker bookkeeping is serialized
+        with latest_lock:
+            detect = tracker.due_for_detection(frame_id)
+        boxes = None
+        if detect:
+            scale, upsample = budget.detection()
+            detect_started = time.perf_counter()
+            with STAGE_SECONDS.time(stage="detect"):
+                boxes = detect_faces(rgb_frame, scale, upsample)
+            budget.record_detection(time.perf_counter() - detect_started)
+
+        with latest_lock:
+            if frame_id <= tracker.frame_id:
+                return
+            if detect:
+                tracks = tracker.update(boxes, rgb_frame, frame_id)
+            else:
+                with STAGE_SECONDS.time(stage="track"):
+                    tracks = tracker.follow(rgb_frame, frame_id)
+            pending = [track for track in tracks if tracker.needs_encoding(track, frame_id)]
+
+        # Tiny, blurred or turned faces and those over the frame's budget
+        # keep waiting for an encoding; the best ones go first
+        pending, held = select_faces(rgb_frame, pending, quality_gate, budget.faces_allowed())
+        for reason in held.values():
+            HELD_FACES.inc(reason=reason)
+        face_encodings, matches = [], []
+        if pending:
+            encode_started = time.perf_counter()
+            face_encodings, matches = identify(rgb_frame, [track.box for track in pending])
+            budget.record_encoding(time.perf_counter() - encode_started, len(pending))
+
+        with latest_lock:
+            for track, match in zip(pending, matches):
+                tracker.set_identity(track, match, frame_id)
+            latest["frame_id"] = frame_id
+            latest["faces"] = [(t.box, t.match) for t in tracks if t.match is not None]
+
+        # Every sighting keeps its visit open; only visits emit history
+        # records and notifications
+        identified = {track.track_id: i for i, track in enumerate(pending)}
+        for track in tracks:
+            if track.match is None:
+                continue
+            top, right, bottom, left = track.box
+            crop = rgb_frame[top:bottom, left:right]
+            i = identified.get(track.track_id)
+            if i is None:
+                visits.observe(track.track_id, crop=crop)
+                continue
+            match = matches[i]
+            if match.name is not None:
+                print(f"Recognized {match.name}! (distance {match.distance:.3f})")
+            visits.observe(track.track_id, match, face_encodings[i], crop)
+        budget.record_frame(time.perf_counter() - started, detect)
+
+    recognizers = WorkerPool(
+        recognition_worker,
+        workers=RECOGNITION_WORKERS,
+        queue_size=RECOGNITION_WORKERS,
+        name="recognition",
+    ).start()
+    watch_queue("recognition", recognizers.queue)
+    grabber = LatestFrameGrabber(parse_source(source)).start()
 
-    print(f"Loaded {len(encodings)} encodings from the database.")
-    return encodings, names
+    try:
+        frame_id = 0
+        while True:
+            frame_id, frame = grabber.read(frame_id)
+            if frame is None:
+                if grabber.failed:
+                    break
+                continue
+
+            # Idle frames skip detection entirely; faces already tracked keep
+            # being followed even if they stand still
+            if motion_gate is None or motion_gate.update(frame) or tracker.tracks:
+                recognizers.submit((frame_id, frame))
+                FRAMES.inc(outcome="processed")
+            else:
+                FRAMES.inc(outcome="idle")
+            visits.tick()
+
+            # Annotating only pays off with a window open or someone watching
+            watched = live_stream is not None and live_stream.has_viewers(0)
+            if HEADLESS and not watched:
+                continue
+            display = frame.copy()
+            with latest_lock:
+                faces = latest["faces"]
+            with STAGE_SECONDS.time(stage="display"):
+                draw_faces(display, faces)
+            if watched:
+                live_stream.publish(0, display)
+            if not HEADLESS:
+                cv2.imshow("Face Recognition", display)
+                if cv2.waitKey(1) & 0xFF == 27:
+                    break
+
+    finally:
+        grabber.stop()
+        recognizers.stop()
+        visits.close_all()
+        if not HEADLESS:
+            cv2.destroyAllWindows()
+
+
+def run_cameras(sources, gallery_name, side_effects, live_stream=None):
+    # One tracker and visit state per stream; recognition itself runs in a
+    # process pool sharing the gallery matrix through shared memory
+    trackers = [FaceTracker() for _ in sources]
+    stream_visits = [make_visit_tracker(side_effects) for _ in sources]
+    motion_gates = [MotionGate() for _ in sources] if MOTION_GATE else None
+
+    def on_result(stream, rgb_frame, frame_id, boxes, encodings, matches):
+        tracks = trackers[stream].update(boxes, rgb_frame, frame_id)
+        by_box = {track.box: track for track in tracks}
+        faces = []
+        for box, encoding, match in zip(boxes, encodings, matches):
+            track = by_box.get(box)
+            if track is not None:
+                top, right, bottom, left = box
+                crop = rgb_frame[top:bottom, left:right]
+                stream_visits[stream].observe(track.track_id, match, encoding, crop)
+            RECOGNITIONS.inc(result="recognized" if match.name is not None else "unknown")
+            faces.append((box, match.name or UNKNOWN_NAME))
+        return faces
+
+    def on_tick():
+        for visits in stream_visits:
+            visits.tick()
+
+    def should_process(stream, frame):
+        if motion_gates is None or motion_gates[stream].update(frame) or trackers[stream].tracks:
+            FRAMES.inc(outcome="processed")
+            return True
+        FRAMES.inc(outcome="idle")
+        return False
+
+    runner = MultiStreamRunner(
+        sources,
+        gallery_name,
+        on_result,
+        on_tick,
+        tolerance=0.7,
+        mode=MATCH_MODE,
+        on_frame=live_stream.publish if live_stream is not None else None,
+        is_watched=live_stream.has_viewers if live_stream is not None else None,
+        headless=HEADLESS,
+        should_process=should_process,
+    )
+    try:
+        runner.run()
+    finally:
+        for visits in stream_visits:
+            visits.close_all()
+        if not HEADLESS:
+            cv2.destroyAllWindows()
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Smart Access camera node")
+    parser.add_argument(
+        "--source",
+        action="append",
+        help="camera index, RTSP URL or video file; repeat for several streams",
+    )
+    args = parser.parse_args()
+    sources = args.source or os.getenv("CAMERA_SOURCES", "0").split(",")
     database_path = "faces/"
-    FCM_TOKEN = os.getenv("FCM_TOKEN")
-    API_URL = os.getenv("API_URL")
-
-    # Global variables to store face encodings
-    global encodings, names
-    encodings, names = load_face_encodings(database_path)
 
-    if len(encodings) == 0:
-        print("No encodings were loaded. Please check the 'faces/' folder.")
+    # The gallery is replaced as a whole, never mutated in place, so the
+    # recognition workers always see a complete gallery
+    global gallery
+    publisher = SharedGalleryPublisher() if len(sources) > 1 else None
+    update_lock = threading.Lock()
+
+    def swap_gallery(updated):
+        global gallery
+        gallery = updated
+        if publisher is not None:
+            publisher.publish(gallery)
+
+    observer = event_handler = sync_client = None
+    if GALLERY_SOURCE == "server":
+        # Pull enrolled vectors from the server instead of encoding faces/
+        def apply_sync(updated, changed_ids):
+            with update_lock:
+                swap_gallery(updated)
+            GALLERY_RELOADS.inc(source="server")
+            print(f"Gallery synced: {len(changed_ids)} changes, {len(updated)} encodings loaded")
+
+        sync_client = GallerySyncClient(API_URL, apply_sync)
+        try:
+            sync_client.pull()
+        except Exception as e:
+            print("Error syncing gallery from the server:", e)
+        gallery = sync_client.gallery
+    else:
+        store = EncodingStore().load()
+        gallery = load_face_encodings(database_path, store)
+
+    if len(gallery) == 0:
+        print("No encodings were loaded. Please check the 'faces/' folder or the server.")
         exit()
-
-    # Set up file system observer
-    def reload_encodings():
-        global encodings, names
-        print("Detected changes in faces directory. Reloading encodings...")
-        encodings, names = load_face_encodings(database_path)
-
-    event_handler = FaceDirectoryHandler(reload_encodings)
-    observer = Observer()
-    observer.schedule(event_handler, database_path, recursive=True)
-    observer.start()
+    if publisher is not None:
+        publisher.publish(gallery)
+
+    def reload_encodings(changed_paths):
+        # Runs on the watcher's timer thread, the camera loop keeps going
+        with update_lock:
+            print(f"Detected {len(changed_paths)} changes in faces directory. Updating encodings...")
+            try:
+                stats = store.update_paths(changed_paths)
+            except Exception as e:
+                print("Error updating encodings:", e)
+                return
+            updated = Gallery.from_store(store)
+            updated.index = index_for(updated, gallery.index, changed_paths)
+            swap_gallery(updated)
+            GALLERY_RELOADS.inc(source="faces")
+            print(
+                f"Gallery updated: {stats['miss']} encoded, {stats['removed']} removed, "
+                f"{len(gallery)} encodings loaded"
+            )
+
+    if sync_client is not None:
+        sync_client.start()
+    else:
+        # Set up file system observer
+        event_handler = FaceDirectoryHandler(reload_encodings)
+        observer = Observer()
+        observer.schedule(event_handler, database_path, recursive=True)
+        observer.start()
+
+    history_writer.start()
+    side_effects = WorkerPool(
+        run_side_effect, workers=1, queue_size=SIDE_EFFECT_QUEUE_SIZE, name="side-effects"
+    ).start()
+    watch_queue("side_effects", side_effects.queue)
+    QUEUE_DEPTH.set_function(history_writer.queue.qsize, queue="history")
+
+    # Prometheus text format on METRICS_PORT, only when METRICS_ENABLED=1
+    metrics_server = MetricsServer().start() if METRICS_ENABLED else None
+
+    # Annotated frames for the app, /stream.mjpg (or /stream/<n>.mjpg per source)
+    live_stream = LiveStream().start() if LIVE_STREAM_PORT else None
 
     try:
-        cap = cv2.VideoCapture(0)
-
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                print("Failed to grab frame")
-                break
-
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            face_locations = face_recognition.face_locations(rgb_frame)
-            face_encodings = face_recognition.face_encodings(rgb_frame, face_locations)
-
-            for (top, right, bottom, left), face_encoding in zip(
-                face_locations, face_encodings
-            ):
-                matches = face_recognition.compare_faces(
-                    encodings, face_encoding, tolerance=0.7
-                )
-                name = "Visitor - Access Pending"
-
-                if True in matches:
-                    matched_names = [names[i] for i, match in enumerate(matches) if match]
-                    name = max(set(matched_names), key=matched_names.count)
-                    face_image = frame[top:bottom, left:right]
-                    pil_image = Image.fromarray(face_image)
-                    print(f"Recognized {name}!")
-
-                    save_image_to_history(pil_image, name, True)
-                    try:
-                        response = requests.post(
-                            f"{API_URL}/send_notification/",
-                            json={
-                                "fcm_token": FCM_TOKEN,
-                                "title": "Registered Person Detected",
-                                "body": f"{name} was recognized",
-                            },
-                        )
-                        print("Notification response:", response.text)
-                        time.sleep(5)
-                    except Exception as e:
-                        print("Error sending notification:", e)
-                else:
-                    face_image = frame[top:bottom, left:right]
-                    pil_image = Image.fromarray(face_image)
-                    save_image_to_history(pil_image, name, False)
-                    try:
-                        response = requests.post(
-                            f"{API_URL}/send_notification/",
-                            json={
-                                "fcm_token": FCM_TOKEN,
-                                "title": "Unknown Person Detected",
-                                "body": "Unregistered person detected",
-                            },
-                        )
-                        print("Notification response:", response.text)
-                        time.sleep(5)
-                    except Exception as e:
-                        print("Error sending notification:", e)
-
-                cv2.rectangle(frame, (left, top), (right, bottom), (0, 255, 0), 2)
-                cv2.putText(
-                    frame, name, (left, top - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2
-                )
-
-            cv2.imshow("Face Recognition", frame)
-
-            if cv2.waitKey(1) & 0xFF == 27:
-                break
-
+        if publisher is None:
+            run_camera(sources[0], side_effects, live_stream)
+        else:
+            run_cameras(sources, publisher.name, side_effects, live_stream)
     finally:
-        observer.stop()
-        observer.join()
-        cap.release()
-        cv2.destroyAllWindows()
+        if live_stream is not None:
+            live_stream.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
+        if sync_client is not None:
+            sync_client.stop()
+        else:
+            observer.stop()
+            observer.join()
+            event_handler.stop()
+        side_effects.stop(drain=True)
+        history_writer.stop()
+        print("History writer:", history_writer.snapshot())
+        if publisher is not None:
+            publisher.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
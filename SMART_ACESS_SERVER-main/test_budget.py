@@ -0,0 +1,16 @@
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("face_recognition")
+
+from budget import FrameBudget  # noqa: E402
+from tracking import DETECTION_SCALE  # noqa: E402
+
+
+def test_empty_levels_turn_the_budget_off():
+    budget = FrameBudget(target_ms=200, levels="")
+    assert not budget.enabled
+    assert budget.detection() == (DETECTION_SCALE, 1)
+    assert budget.faces_allowed() is None
+    budget.record_frame(1.0, True)
+    assert budget.level == 0
@@ -0,0 +1,137 @@
+import asyncio
+import hashlib
+import io
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+# Longest side in pixels of every derivative size
+SIZES = {"thumb": 160, "medium": 640}
+FORMATS = {"jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", 80))
+THUMBNAIL_CACHE_DIR = os.getenv("THUMBNAIL_CACHE_DIR", "thumbnails/")
+THUMBNAIL_CACHE_MAX_BYTES = int(os.getenv("THUMBNAIL_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", 2))
+
+
+def render(source_path, size, fmt, quality):
+    with Image.open(source_path) as image:
+        # Let the JPEG decoder downscale while decoding, far cheaper than a
+        # full-size decode followed by a resize
+        image.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((size, size), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, FORMATS[fmt][0], quality=quality)
+    return output.getvalue()
+
+
+class ThumbnailCache:
+    """Resized and re-encoded copies of images kept on disk, evicting the
+    least recently used ones once the cache exceeds ``max_bytes``.
+
+    The cache key (also the ETag) is derived from the source file's size and
+    mtime plus the requested variant, so replacing a source image never
+    serves a stale derivative.
+    """
+
+    def __init__(
+        self,
+        cache_dir=THUMBNAIL_CACHE_DIR,
+        max_bytes=THUMBNAIL_CACHE_MAX_BYTES,
+        workers=THUMBNAIL_WORKERS,
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="thumbnails")
+        # cache key -> size in bytes, least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        # cache key -> future of a derivative being rendered right now
+        self.rendering = {}
+
+    def load(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        files = []
+        for file in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, file)
+            if file.endswith(".tmp"):
+                # left behind by a render interrupted by a restart
+                os.remove(path)
+            elif os.path.isfile(path):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, file, stat.st_size))
+        for _, file, size in sorted(files):
+            self.entries[file] = size
+            self.total_bytes += size
+        return self
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    @staticmethod
+    def cache_key(source_path, size, fmt, quality):
+        stat = os.stat(source_path)
+        variant = f"{source_path}:{stat.st_size}:{stat.st_mtime_ns}:{size}:{quality}"
+        return f"{hashlib.sha1(variant.encode()).hexdigest()}.{fmt}"
+
+    async def get(self, source_path, key, size, fmt, quality):
+        """Bytes of the derivative ``key`` of ``source_path``."""
+        path = os.path.join(self.cache_dir, key)
+        loop = asyncio.get_running_loop()
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            try:
+                return await loop.run_in_executor(self.executor, _read, path)
+            except FileNotFoundError:
+                self._forget(key)
+
+        # Concurrent requests for the same derivative share one render, which
+        # finishes even if the client that started it disconnects
+        future = self.rendering.get(key)
+        if future is None:
+            future = loop.run_in_executor(
+                self.executor, _render_to, source_path, path, size, fmt, quality
+            )
+            self.rendering[key] = future
+            future.add_done_callback(lambda done: self._rendered(key, done))
+        return await asyncio.shield(future)
+
+    def _rendered(self, key, future):
+        del self.rendering[key]
+        if not future.cancelled() and future.exception() is None:
+            self._remember(key, len(future.result()))
+
+    def _remember(self, key, size):
+        self.entries[key] = size
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            oldest, _ = next(iter(self.entries.items()))
+            self._forget(oldest)
+            try:
+                os.remove(os.path.join(self.cache_dir, oldest))
+            except FileNotFoundError:
+                pass
+
+    def _forget(self, key):
+        self.total_bytes -= self.entries.pop(key, 0)
+
+
+def _read(path):
+    # mtime doubles as the last use time when the cache is reloaded
+    os.utime(path)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _render_to(source_path, path, size, fmt, quality):
+    data = render(source_path, size, fmt, quality)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    return data
@@ -0,0 +1,216 @@
+import os
+
+import cv2
+import face_recognition
+import numpy as np
+
+# Run the HOG detector every DETECTION_INTERVAL frames on a copy of the
+# frame scaled by DETECTION_SCALE; faces are tracked in between
+DETECTION_INTERVAL = int(os.getenv("DETECTION_INTERVAL", 5))
+DETECTION_SCALE = float(os.getenv("DETECTION_SCALE", 0.5))
+TRACK_IOU = float(os.getenv("TRACK_IOU", 0.3))
+TRACK_MAX_MISSES = int(os.getenv("TRACK_MAX_MISSES", 2))
+# Correlation below this means the tracker lost the face, detect again
+TRACK_MIN_SCORE = float(os.getenv("TRACK_MIN_SCORE", 0.5))
+# Re-encode a tracked face after this many frames even if nothing changed
+REENCODE_INTERVAL = int(os.getenv("REENCODE_INTERVAL", 60))
+
+
+def detect_faces(rgb_frame, scale=DETECTION_SCALE, upsample=1, model="hog"):
+    """face_locations on a downscaled copy, boxes mapped back to full size."""
+    small = rgb_frame
+    if scale != 1.0:
+        small = cv2.resize(rgb_frame, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    locations = face_recognition.face_locations(
+        small, number_of_times_to_upsample=upsample, model=model
+    )
+    height, width = rgb_frame.shape[:2]
+    return [
+        (
+            max(0, int(top / scale)),
+            min(width, int(right / scale)),
+            min(height, int(bottom / scale)),
+            max(0, int(left / scale)),
+        )
+        for top, right, bottom, left in locations
+    ]
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """IoU between two lists of (top, right, bottom, left) boxes."""
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    top = np.maximum(a[:, None, 0], b[None, :, 0])
+    right = np.minimum(a[:, None, 1], b[None, :, 1])
+    bottom = np.minimum(a[:, None, 2], b[None, :, 2])
+    left = np.maximum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+    area_a = (a[:, 1] - a[:, 3]) * (a[:, 2] - a[:, 0])
+    area_b = (b[:, 1] - b[:, 3]) * (b[:, 2] - b[:, 0])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-6), 0.0)
+
+
+class Track:
+    def __init__(self, track_id, box, frame_id):
+        self.track_id = track_id
+        self.box = box
+        self.first_seen = frame_id
+        self.last_seen = frame_id
+        self.misses = 0
+        # identity from the last encoding; None until the face is encoded
+        self.match = None
+        self.encoded_at = None
+        self.score = 1.0
+        self.template = None
+
+
+class FaceTracker:
+    """Keeps face boxes alive between detections and caches the identity
+    per track, so faces are only encoded when a track appears, after
+    REENCODE_INTERVAL frames or when tracking confidence drops."""
+
+    def __init__(
+        self,
+        interval=DETECTION_INTERVAL,
+        scale=DETECTION_SCALE,
+        iou_threshold=TRACK_IOU,
+        max_misses=TRACK_MAX_MISSES,
+        min_score=TRACK_MIN_SCORE,
+        reencode_interval=REENCODE_INTERVAL,
+    ):
+        self.interval = max(1, interval)
+        self.scale = scale
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.min_score = min_score
+        self.reencode_interval = reencode_interval
+        self.tracks = []
+        self.next_id = 1
+        self.frame_id = 0
+        self.last_detection = None
+
+    def due_for_detection(self, frame_id):
+        if self.last_detection is None or frame_id - self.last_detection >= self.interval:
+            return True
+        return any(track.score < self.min_score for track in self.tracks)
+
+    def needs_encoding(self, track, frame_id):
+        if track.match is None or track.score < self.min_score:
+            return True
+        return frame_id - track.encoded_at >= self.reencode_interval
+
+    def set_identity(self, track, match, frame_id):
+        track.match = match
+        track.encoded_at = frame_id
+
+    def _gray(self, rgb_frame):
+        gray = cv2.cvtColor(rgb_frame, cv2.COLOR_RGB2GRAY)
+        if self.scale != 1.0:
+            gray = cv2.resize(gray, (0, 0), fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        return gray
+
+    def _scaled(self, box):
+        top, right, bottom, left = box
+        s = self.scale
+        return int(top * s), int(right * s), int(bottom * s), int(left * s)
+
+    def _set_template(self, track, gray):
+        top, right, bottom, left = self._scaled(track.box)
+        template = gray[top:bottom, left:right]
+        track.template = template.copy() if template.size else None
+
+    def update(self, boxes, rgb_frame, frame_id):
+        """Associate fresh detections with the existing tracks by IoU."""
+        self.frame_id = frame_id
+        self.last_detection = frame_id
+        gray = self._gray(rgb_frame)
+
+        unmatched_boxes = list(range(len(boxes)))
+        matched_tracks = set()
+        if self.tracks and boxes:
+            overlaps = iou_matrix([t.box for t in self.tracks], boxes)
+            # Greedy assignment, best overlaps first
+            for flat in np.argsort(-overlaps, axis=None):
+                t, b = np.unravel_index(flat, overlaps.shape)
+                if overlaps[t, b] < self.iou_threshold:
+                    break
+                if t in matched_tracks or b not in unmatched_boxes:
+                    continue
+                track = self.tracks[t]
+                track.box = boxes[b]
+                track.last_seen = frame_id
+                track.misses = 0
+                track.score = 1.0
+                self._set_template(track, gray)
+                matched_tracks.add(t)
+                unmatched_boxes.remove(b)
+
+        survivors = []
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track.misses += 1
+                if track.misses > self.max_misses:
+                    continue
+            survivors.append(track)
+
+        for b in unmatched_boxes:
+            track = Track(self.next_id, boxes[b], frame_id)
+            self.next_id += 1
+            self._set_template(track, gray)
+            survivors.append(track)
+
+        self.tracks = survivors
+        return self.tracks
+
+    def follow(self, rgb_frame, frame_id):
+        """Move every track by template matching around its last box."""
+        self.frame_id = frame_id
+        gray = self._gray(rgb_frame)
+        height, width = gray.shape[:2]
+        for track in self.tracks:
+            if track.template is None:
+                track.score = 0.0
+                continue
+            top, right, bottom, left = self._scaled(track.box)
+            box_h, box_w = track.template.shape[:2]
+            pad_y, pad_x = box_h // 2, box_w // 2
+            y0, y1 = max(0, top - pad_y), min(height, bottom + pad_y)
+            x0, x1 = max(0, left - pad_x), min(width, right + pad_x)
+            window = gray[y0:y1, x0:x1]
+            if window.shape[0] < box_h or window.shape[1] < box_w:
+                track.score = 0.0
+                continue
+
+            result = cv2.matchTemplate(window, track.template, cv2.TM_CCOEFF_NORMED)
+            _, score, _, (dx, dy) = cv2.minMaxLoc(result)
+            track.score = float(score)
+            if score >= self.min_score:
+                new_top = (y0 + dy) / self.scale
+                new_left = (x0 + dx) / self.scale
+                track.box = (
+                    int(new_top),
+                    int(new_left + box_w / self.scale),
+                    int(new_top + box_h / self.scale),
+                    int(new_left),
+                )
+                track.last_seen = frame_id
+        return self.tracks
+
+    def process(self, rgb_frame, frame_id, identify):
+        """Detect or follow faces in one frame and identify the tracks that
+        need it. ``identify(rgb_frame, boxes)`` returns one match per box.
+
+        Returns (box, match) for every track that has an identity.
+        """
+        if self.due_for_detection(frame_id):
+            tracks = self.update(detect_faces(rgb_frame, self.scale), rgb_frame, frame_id)
+        else:
+            tracks = self.follow(rgb_frame, frame_id)
+
+        pending = [track for track in tracks if self.needs_encoding(track, frame_id)]
+        if pending:
+            matches = identify(rgb_frame, [track.box for track in pending])
+            for track, match in zip(pending, matches):
+                self.set_identity(track, match, frame_id)
+        return [(track.box, track.match) for track in tracks if track.match is not None]
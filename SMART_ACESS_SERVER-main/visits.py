@@ -0,0 +1,191 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+# A visit is closed after its identity has not been seen for VISIT_TIMEOUT
+VISIT_TIMEOUT = float(os.getenv("VISIT_TIMEOUT", 10))
+# Unknown faces closer than this to an open unknown visit join that visit
+UNKNOWN_CLUSTER_TOLERANCE = float(os.getenv("UNKNOWN_CLUSTER_TOLERANCE", 0.6))
+# Unknown visits only notify once they lasted this long, so a face that is
+# recognized on its second look does not raise a false alert
+UNKNOWN_CONFIRM_SECONDS = float(os.getenv("UNKNOWN_CONFIRM_SECONDS", 2))
+
+
+def crop_quality(crop):
+    """Sharpness (variance of the Laplacian) weighted by face area."""
+    if crop is None or crop.size == 0:
+        return 0.0
+    gray = cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY)
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var()) * gray.shape[0] * gray.shape[1]
+
+
+class Visit:
+    def __init__(self, key, name, recognized, now, encoding=None):
+        self.key = key
+        self.name = name
+        self.recognized = recognized
+        self.opened_at = now
+        self.started = datetime.now()
+        self.last_seen = now
+        self.notified = False
+        self.best_crop = None
+        self.best_quality = -1.0
+        self.best_distance = float("inf")
+        # running mean of the encodings, used to cluster unknown faces
+        self.encoding = encoding
+        self.encoding_count = 1 if encoding is not None else 0
+        self.track_ids = set()
+
+    def add_encoding(self, encoding):
+        if self.encoding is None:
+            self.encoding = np.asarray(encoding, dtype=np.float32)
+            self.encoding_count = 1
+            return
+        self.encoding_count += 1
+        self.encoding = self.encoding + (encoding - self.encoding) / self.encoding_count
+
+
+class VisitTracker:
+    """Turns per-frame sightings into visits.
+
+    ``on_open(visit)`` is called once when a visit starts (for unknown faces
+    once the visit has lasted UNKNOWN_CONFIRM_SECONDS) and ``on_close(visit)``
+    once when it ends, with the best crop seen during the whole visit.
+    """
+
+    def __init__(
+        self,
+        on_open,
+        on_close,
+        timeout=VISIT_TIMEOUT,
+        cluster_tolerance=UNKNOWN_CLUSTER_TOLERANCE,
+        unknown_confirm=UNKNOWN_CONFIRM_SECONDS,
+    ):
+        self.on_open = on_open
+        self.on_close = on_close
+        self.timeout = timeout
+        self.cluster_tolerance = cluster_tolerance
+        self.unknown_confirm = unknown_confirm
+        self.visits = {}
+        self.track_visits = {}
+        self.next_unknown = 1
+        self.lock = threading.Lock()
+
+    def _unknown_key(self, encoding):
+        best_key, best_distance = None, self.cluster_tolerance
+        for key, visit in self.visits.items():
+            if visit.recognized or visit.encoding is None:
+                continue
+            distance = float(np.linalg.norm(visit.encoding - encoding))
+            if distance <= best_distance:
+                best_key, best_distance = key, distance
+        if best_key is None:
+            best_key = f"unknown-{self.next_unknown}"
+            self.next_unknown += 1
+        return best_key
+
+    def observe(self, track_id, match=None, encoding=None, crop=None, now=None):
+        """Record a sighting of ``track_id``.
+
+        Pass ``match`` (and ``encoding`` for unknown faces) when the face was
+        just identified; sightings of an already identified track only keep
+        its visit alive and offer a better crop.
+        """
+        now = time.monotonic() if now is None else now
+        opened = None
+        with self.lock:
+            if match is not None:
+                if match.name is not None:
+                    key = match.name
+                elif encoding is not None:
+                    key = self._unknown_key(encoding)
+                else:
+                    return
+                previous = self.track_visits.get(track_id)
+                if previous is not None and previous != key:
+                    self._detach(track_id, previous)
+                self.track_visits[track_id] = key
+            else:
+                key = self.track_visits.get(track_id)
+                if key is None:
+                    return
+
+            visit = self.visits.get(key)
+            if visit is None:
+                recognized = match is not None and match.name is not None
+                name = match.name if recognized else None
+                visit = Visit(key, name, recognized, now)
+                self.visits[key] = visit
+                if recognized:
+                    visit.notified = True
+                    opened = visit
+
+            visit.last_seen = now
+            visit.track_ids.add(track_id)
+            if match is not None:
+                visit.best_distance = min(visit.best_distance, match.distance)
+                if not visit.recognized and encoding is not None:
+                    visit.add_encoding(encoding)
+
+            quality = crop_quality(crop)
+            if quality > visit.best_quality:
+                visit.best_quality = quality
+                visit.best_crop = crop.copy()
+
+        if opened is not None:
+            self.on_open(opened)
+
+    def _detach(self, track_id, key):
+        # A track that turned out to be someone else; drop an unknown visit
+        # that only ever saw this track and has not alerted yet
+        visit = self.visits.get(key)
+        if visit is None:
+            return
+        visit.track_ids.discard(track_id)
+        if not visit.recognized and not visit.track_ids and not visit.notified:
+            del self.visits[key]
+
+    def tick(self, now=None):
+        """Confirm pending unknown visits and close expired ones."""
+        now = time.monotonic() if now is None else now
+        opened, closed = [], []
+        with self.lock:
+            for key, visit in list(self.visits.items()):
+                if now - visit.last_seen >= self.timeout:
+                    del self.visits[key]
+                    if not visit.notified:
+                        # a short unknown visit still gets its one alert
+                        visit.notified = True
+                        opened.append(visit)
+                    closed.append(visit)
+                elif not visit.notified and now - visit.opened_at >= self.unknown_confirm:
+                    visit.notified = True
+                    opened.append(visit)
+            if closed:
+                live = set(self.visits)
+                self.track_visits = {
+                    track_id: key for track_id, key in self.track_visits.items() if key in live
+                }
+
+        for visit in opened:
+            self.on_open(visit)
+        for visit in closed:
+            self.on_close(visit)
+
+    def close_all(self):
+        with self.lock:
+            visits = list(self.visits.values())
+            self.visits = {}
+            self.track_visits = {}
+        for visit in visits:
+            if not visit.notified:
+                visit.notified = True
+                self.on_open(visit)
+            self.on_close(visit)
+
+    def __len__(self):
+        return len(self.visits)
@@ -2,44 +2,48 @@ import cv2
 import numpy as np
 import face_recognition
 import os
+import sys
 
-encodings = []
-names = []
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "SMART_ACESS_SERVER-main")
+)
+
+from encoding_store import load_store  # noqa: E402
+from gallery import Gallery  # noqa: E402
+from tracking import FaceTracker  # noqa: E402
 
 database_path = "faces/"
 
-# Loop through each person's folder
-for person_name in os.listdir(database_path):
-    person_folder = os.path.join(database_path, person_name)
-    if os.path.isdir(person_folder):  # Ensure it's a folder
-        for file in os.listdir(person_folder):
-            if file.endswith(".jpg") or file.endswith(".png"):
-                image_path = os.path.join(person_folder, file)
-                image = face_recognition.load_image_file(image_path)
-                encoding = face_recognition.face_encodings(image)
-                if encoding:
-                    encodings.append(encoding[0])
-                    names.append(person_name)  # Use folder name as person's name
+# Encodings are cached on disk, only new or changed images are re-encoded
+store = load_store(database_path)
+gallery = Gallery.from_store(store)
+
+# DETECTION_INTERVAL / DETECTION_SCALE control how often and at which size
+# faces are detected, tracked faces are only re-encoded when needed
+tracker = FaceTracker()
+
+
+def identify(rgb_frame, face_locations):
+    face_encodings = face_recognition.face_encodings(rgb_frame, face_locations)
+    return gallery.match(face_encodings, tolerance=0.5)
+
 
 cap = cv2.VideoCapture(0)
+frame_id = 0
 
 while True:
     ret, frame = cap.read()
     if not ret:
         break
+    frame_id += 1
 
     rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
 
-    face_locations = face_recognition.face_locations(rgb_frame)
-    face_encodings = face_recognition.face_encodings(rgb_frame, face_locations)
-
-    for (top, right, bottom, left), face_encoding in zip(face_locations, face_encodings):
-        matches = face_recognition.compare_faces(encodings, face_encoding, tolerance=0.5)
+    for (top, right, bottom, left), match in tracker.process(rgb_frame, frame_id, identify):
         name = "Visitor - Access Pending"
 
-        if True in matches:
-            first_match_index = matches.index(True)
-            name = names[first_match_index]
+        if match.name is not None:
+            name = match.name
 
         cv2.rectangle(frame, (left, top), (right, bottom), (0, 255, 0), 2)
         cv2.putText(frame, name, (left, top - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)